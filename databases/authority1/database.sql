@@ -43,6 +43,7 @@ CREATE TABLE handshake_numbers (
     process_instance TEXT,
     reader_address TEXT,
     handshake_number TEXT,
+    expires REAL,
     primary key (process_instance, reader_address)
 );
 
@@ -43,3 +43,11 @@ CREATE TABLE authorities_generated_decription_keys (
     decription_key TEXT,
     primary key (process_instance, reader_address, authority_name)
 );
+
+CREATE TABLE reader_key_rings (
+    process_instance TEXT,
+    reader_address TEXT,
+    fingerprint TEXT,
+    key_ring BLOB,
+    primary key (process_instance, reader_address)
+);
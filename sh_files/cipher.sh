@@ -6,6 +6,10 @@ policies=""
 sender_name=""
 function=""
 case_id=""
+key_per_policy=""
+workers="1"
+validate=""
+service=""
 
 # Parse command-line arguments
 while [ $# -gt 0 ]; do
@@ -36,6 +40,24 @@ while [ $# -gt 0 ]; do
       shift
       shift
       ;;
+    -k|--key_per_policy)
+      key_per_policy="--key_per_policy"
+      shift
+      ;;
+    -v|--validate)
+      validate="--validate"
+      shift
+      ;;
+    -S|--service)
+      service="$2"
+      shift
+      shift
+      ;;
+    -w|--workers)
+      workers="$2"
+      shift
+      shift
+      ;;
     *)
       echo "Unknown option $1"
       exit 1
@@ -64,11 +86,35 @@ if [ -z "$function" ]; then
   exit 1
 fi
 
+# Queue the job on a running data owner service (data_owner_service.py) instead of starting a new process
+if [ -n "$service" ]; then
+  input=$(realpath "$input")
+  policies=$(realpath "$policies")
+  # The job is encoded by python, file names may contain quotes or backslashes
+  json=$(python3 - "$input" "$policies" "$sender_name" "$function" "$workers" "$case_id" "$key_per_policy" "$validate" <<'JOB'
+import sys
+import json
+input_path, policies, sender_name, function, workers, case_id, key_per_policy, validate = sys.argv[1:]
+job = {'input': input_path, 'policies': policies, 'sender_name': sender_name, 'function': function,
+       'workers': int(workers), 'key_per_policy': bool(key_per_policy), 'validate': bool(validate)}
+if case_id:
+    job['case_id'] = case_id
+print(json.dumps(job))
+JOB
+) || exit 1
+  # The service only accepts requests carrying its token
+  token=$(grep '^DATA_OWNER_SERVICE_TOKEN=' ../src/.env | cut -d '=' -f 2- | tr -d '"')
+  curl -s -X POST -H "Content-Type: application/json" -H "Authorization: Bearer $token" -d "$json" "$service/jobs"
+  echo
+  echo "✅ Data owner cipher job queued"
+  exit 0
+fi
+
 # Execute the data owner script with optional caseKD
 if [ -n "$case_id" ]; then
-  python3 ../src/data_owner.py -i "$input" -p "$policies" -s "$sender_name" -f "$function" --case_id "$case_id"
+  python3 ../src/data_owner.py -i "$input" -p "$policies" -s "$sender_name" -f "$function" --case_id "$case_id" --workers "$workers" $key_per_policy $validate
 else
-  python3 ../src/data_owner.py -i "$input" -p "$policies" -s "$sender_name" -f "$function"
+  python3 ../src/data_owner.py -i "$input" -p "$policies" -s "$sender_name" -f "$function" --workers "$workers" $key_per_policy $validate
 fi
 
 echo "✅ Data owner cipher done"
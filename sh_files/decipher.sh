@@ -6,6 +6,7 @@ message_id=""
 slice_id=""
 output_folder=""
 function=""
+selection=""
 
 # Parse command-line arguments
 while [ $# -gt 0 ]; do
@@ -36,6 +37,14 @@ while [ $# -gt 0 ]; do
             shift
             shift
             ;;
+        -l|--list)
+            selection="--list"
+            shift
+            ;;
+        -a|--all)
+            selection="--all"
+            shift
+            ;;
         *)
             echo "Unknown option $1"
             exit 1
@@ -63,14 +72,11 @@ if [ -z "$function" ]; then
     exit 1
 fi
 
-filename="../src/.env"
-count=$(grep -c '^[^#]*''NAME="AUTH' "$filename")
-
-# Run handshake and key generation for each authority
-for i in $(seq 1 $count); do
-    python3 ../src/client.py --handshake -a "$i" -r "$requester_name"
-    python3 ../src/client.py --generate_key -a "$i" -r "$requester_name"
-done
+# Run handshake and key generation with all the authorities concurrently, one connection each
+if ! python3 ../src/client.py --all_authorities -r "$requester_name"; then
+    echo "❌ Key generation failed"
+    exit 1
+fi
 
 # Validate message_id format and correct it from cache if needed
 if ! echo "$message_id" | grep -qE '^[0-9]{20}$'; then
@@ -96,8 +102,8 @@ if ! echo "$ipfs_link" | grep -Eq '^(Qm|bafy)[1-9A-HJ-NP-Za-km-z]{44,}$'; then
     exit 1
 fi
 
-# Count the number of slices in the retrieved IPFS object
-count_of_slices=$(ipfs cat "$ipfs_link" | python3 -c "import sys, json; data = sys.stdin.read(); print(len(json.loads(data).get('header', [])))")
+# Count the number of slices in the retrieved manifest (or in the header of older messages)
+count_of_slices=$(ipfs cat "$ipfs_link" | python3 -c "import sys, json; data = json.loads(sys.stdin.read()); print(len(data.get('slices', data.get('header', []))))")
 
 # Ensure count_of_slices is numeric
 if ! echo "$count_of_slices" | grep -qE '^[0-9]+$'; then
@@ -105,8 +111,12 @@ if ! echo "$count_of_slices" | grep -qE '^[0-9]+$'; then
     exit 1
 fi
 
-# Run reader with or without slice_id
-if [ -z "$slice_id" ]; then
+# Run reader listing or decrypting every slice the reader can open, or with or without slice_id
+if [ -n "$selection" ]; then
+    python3 ../src/reader.py --message_id "$message_id" \
+        --reader_name "$requester_name" --output_folder "$output_folder" \
+        --function "$function" $selection
+elif [ -z "$slice_id" ]; then
     if [ "$count_of_slices" -gt 1 ]; then
         echo "You need to specify the slice id (--slice_id) since the message_id has $count_of_slices slices!"
         exit 1
@@ -1,5 +1,6 @@
 from charm.toolbox.pairinggroup import *
 from maabe_class import *
+from hash_cache import hash_cache
 import block_int
 import mpc_setup
 from decouple import config
@@ -100,10 +101,8 @@ class Authority:
         # Generate public and private keys for Authority based on public parameters
         response = self.retrieve_public_parameters(process_instance_id)
         public_parameters = bytesToObject(response, groupObj)
-        H = lambda x: group.hash(x, G2)
-        F = lambda x: group.hash(x, G2)
-        public_parameters["H"] = H
-        public_parameters["F"] = F
+        public_parameters["H"] = hash_cache(groupObj).hash
+        public_parameters["F"] = hash_cache(groupObj).hash
         (pk1, sk1) = maabe.authsetup(public_parameters, authorities_names[self.authority_number - 1])
         pk1_bytes = objectToBytes(pk1, groupObj)
         sk1_bytes = objectToBytes(sk1, groupObj)
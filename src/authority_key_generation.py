@@ -1,10 +1,14 @@
 from charm.toolbox.pairinggroup import *
 from maabe_class import *
+from hash_cache import hash_cache
 from charm.core.engine.util import objectToBytes, bytesToObject
 import ipfshttpclient
 import block_int
+import wire_protocol
 import sqlite3
 import json
+import threading
+import time
 from authorities_info import authorities_names
 
 def retrieve_public_parameters(authority_number, process_instance_id):
@@ -20,39 +24,10 @@ def retrieve_public_parameters(authority_number, process_instance_id):
     public_parameters = result[0][2].encode()
     return public_parameters
 
-def generate_user_key(authority_number, gid, process_instance_id, reader_address):
-    # Get the names of the Authorities for attribute retrieval
-    authorities_names_value = authorities_names()
-    
-    # Connect to the SQLite3 Authority database
-    conn = sqlite3.connect('../databases/authority' + str(authority_number) + '/authority' + str(authority_number) + '.db')
-    x = conn.cursor()
-    
-    # Initialize the pairing group and MA-ABE instance
-    groupObj = PairingGroup('SS512')
-    maabe = MaabeRW15(groupObj)
-    
-    # Connect to the IPFS API
-    api = ipfshttpclient.connect('/ip4/127.0.0.1/tcp/5001')
-    
-    # Retrieve public parameters for the given Authority and process instance
-    response = retrieve_public_parameters(authority_number, process_instance_id)
-    public_parameters = bytesToObject(response, groupObj)
-    
-    # Define hash functions H and F for the public parameters
-    H = lambda x: self.group.hash(x, G2)
-    F = lambda x: self.group.hash(x, G2)
-    public_parameters["H"] = H
-    public_parameters["F"] = F
-    
-    # Retrieve the user's private key based on the process instance ID
-    x.execute("SELECT * FROM private_keys WHERE process_instance=?", (process_instance_id,))
-    result = x.fetchall()
-    sk1 = result[0][1]
-    sk1 = bytesToObject(sk1, groupObj)
-    
+def retrieve_users_attributes(api, process_instance_id, attributes_ipfs_link=None):
     # Retrieve user attributes stored in IPFS for the given process instance
-    attributes_ipfs_link = block_int.retrieve_users_attributes(process_instance_id)
+    if attributes_ipfs_link is None:
+        attributes_ipfs_link = block_int.retrieve_users_attributes(process_instance_id)
     getfile = api.cat(attributes_ipfs_link)
     
     # Clean up the retrieved file data and decode it
@@ -62,16 +37,104 @@ def generate_user_key(authority_number, gid, process_instance_id, reader_address
     getfile = getfile.split(b'####')
     
     # Load the user attributes into a dictionary
-    attributes_dict = json.loads(getfile[1].decode('utf-8'))
-    user_attr1 = attributes_dict[reader_address]
-    
-    # Filter user attributes based on the Authority name
-    user_attr1 = [k for k in user_attr1 if k.endswith(authorities_names_value[int(authority_number) - 1])]
-    
-    # Generate the user's secret key using attributes
-    user_sk1 = maabe.multiple_attributes_keygen(public_parameters, sk1, gid, user_attr1)
-    
-    # Convert the user secret key to bytes for transmission
-    user_sk1_bytes = objectToBytes(user_sk1, groupObj)
-    return user_sk1_bytes
+    return json.loads(getfile[1].decode('utf-8'))
+
+class AuthorityContext:
+    """
+    Everything the Authority needs to generate keys for a process instance, loaded once: the pairing group,
+    the public parameters, the Authority secret key with g2^alpha precomputed, and the attributes of the users.
+    The attributes link is checked on chain again after attributes_ttl seconds, and the attributes are
+    downloaded again when the certifier published new ones
+    """
+    attributes_ttl = 60
+
+    def __init__(self, authority_number, process_instance_id):
+        self.authority_number = authority_number
+        self.process_instance_id = process_instance_id
+        self.authority_name = authorities_names()[int(authority_number) - 1]
+        self.lock = threading.Lock()
+        self.attributes_link = None
+        
+        # Initialize the pairing group and MA-ABE instance
+        self.groupObj = PairingGroup('SS512')
+        self.maabe = MaabeRW15(self.groupObj)
+        self.api = ipfshttpclient.connect('/ip4/127.0.0.1/tcp/5001')
+        
+        # Retrieve public parameters for the given Authority and process instance
+        response = retrieve_public_parameters(authority_number, process_instance_id)
+        self.public_parameters = bytesToObject(response, self.groupObj)
+        self.public_parameters["H"] = hash_cache(self.groupObj).hash
+        self.public_parameters["F"] = hash_cache(self.groupObj).hash
+        
+        # Retrieve the Authority secret key and precompute g2^alpha
+        conn = sqlite3.connect('../databases/authority' + str(authority_number) + '/authority' + str(authority_number) + '.db')
+        x = conn.cursor()
+        x.execute("SELECT * FROM private_keys WHERE process_instance=?", (process_instance_id,))
+        result = x.fetchall()
+        conn.close()
+        self.sk = bytesToObject(result[0][1], self.groupObj)
+        self.maabe.precompute_authority(self.public_parameters, self.sk)
+        self.load_attributes()
+
+    # Parses the users' attributes file, keeping the attributes managed by this Authority,
+    # if its link on chain changed since it was loaded
+    def load_attributes(self):
+        attributes_ipfs_link = block_int.retrieve_users_attributes(self.process_instance_id)
+        if attributes_ipfs_link != self.attributes_link:
+            attributes_dict = retrieve_users_attributes(self.api, self.process_instance_id, attributes_ipfs_link)
+            self.attributes = {reader_address: [k for k in user_attr if k.endswith(self.authority_name)]
+                               for reader_address, user_attr in attributes_dict.items()}
+            self.attributes_link = attributes_ipfs_link
+        self.attributes_checked = time.monotonic()
+
+    def user_attributes(self, reader_address):
+        # A reader missing from the table may have been certified after it was loaded, and the attributes
+        # of the others may have changed or been revoked since they were checked
+        with self.lock:
+            if reader_address not in self.attributes or time.monotonic() - self.attributes_checked > self.attributes_ttl:
+                self.load_attributes()
+            return self.attributes[reader_address]
+
+    def generate_user_key(self, gid, reader_address, raw=False):
+        user_sk1 = self.maabe.multiple_attributes_keygen(self.public_parameters, self.sk, gid, self.user_attributes(reader_address))
+        if raw:
+            # Raw compressed points of the binary protocol
+            return wire_protocol.encode_key(self.groupObj, user_sk1)
+        return objectToBytes(user_sk1, self.groupObj)
+
+    def generate_user_keys(self, readers):
+        # Generate the keys of many readers, each one identified by its address, in the raw encoding
+        users, results = {}, []
+        for reader_address in readers:
+            try:
+                users[reader_address] = self.user_attributes(reader_address)
+            except KeyError:
+                results.append((reader_address, None, 'No attributes certified for the reader'))
+        user_keys = self.maabe.multiple_users_keygen(self.public_parameters, self.sk, users)
+        for reader_address, user_sk1 in user_keys.items():
+            results.append((reader_address, wire_protocol.encode_key(self.groupObj, user_sk1), None))
+        return results
+
+# Contexts of the process instances served by this process
+contexts = {}
+contexts_lock = threading.Lock()
+
+def authority_context(authority_number, process_instance_id):
+    # Return the context of the process instance, loading it on first use
+    key = (int(authority_number), str(process_instance_id))
+    with contexts_lock:
+        if key not in contexts:
+            contexts[key] = AuthorityContext(authority_number, process_instance_id)
+        return contexts[key]
+
+def generate_user_key(authority_number, gid, process_instance_id, reader_address, raw=False):
+    # Generate the user's secret key for the attributes of this Authority, from the preloaded context
+    return authority_context(authority_number, process_instance_id).generate_user_key(gid, reader_address, raw)
+
+def init_keygen_worker(attributes_ttl):
+    # Settings of the server, for the worker processes started without a copy of its memory
+    AuthorityContext.attributes_ttl = attributes_ttl
 
+def generate_user_keys(authority_number, process_instance_id, readers):
+    # Generate the keys of a chunk of readers, on a worker process keeping its own preloaded context
+    return authority_context(authority_number, process_instance_id).generate_user_keys(readers)
@@ -6,6 +6,13 @@ import sqlite3
 import argparse
 import sys
 import io
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from authorities_info import authorities_names
+from charm.toolbox.pairinggroup import PairingGroup
+from charm.core.engine.util import objectToBytes
+import wire_protocol
 
 
 def sign_number(authority_invoked):
@@ -13,14 +20,38 @@ def sign_number(authority_invoked):
     x.execute("SELECT * FROM handshake_number WHERE process_instance=? AND authority_name=? AND reader_address=?",
               (str(process_instance_id), authority_invoked, reader_address))
     result = x.fetchall()
+    if not result:
+        raise Exception(f"No handshake with {authority_invoked}, request one with --handshake")
     number_to_sign = result[0][3]
+    return sign(number_to_sign)
 
+
+def store_number_to_sign(authority_name, number_to_sign):
+    # The Authority replaces the pending number at every handshake, keep only the last one
+    x.execute("INSERT OR REPLACE INTO handshake_number VALUES (?,?,?,?)",
+              (str(process_instance_id), reader_address, authority_name, number_to_sign))
+    connection.commit()
+
+
+def store_partial_key(authority_name, key):
+    # The number to sign is consumed by the Authority with the key request
+    x.execute("INSERT OR IGNORE INTO authorities_generated_decription_keys VALUES (?,?,?,?)",
+              (str(process_instance_id), reader_address, authority_name, key))
+    x.execute("DELETE FROM handshake_number WHERE process_instance=? AND reader_address=? AND authority_name=?",
+              (str(process_instance_id), reader_address, authority_name))
+    connection.commit()
+
+
+def reader_private_key(address=None):
     # Retrieve the RSA private key for the reader Address
-    x.execute("SELECT * FROM rsa_private_key WHERE reader_address=?", (reader_address,))
+    x.execute("SELECT * FROM rsa_private_key WHERE reader_address=?", (address or reader_address,))
     result = x.fetchall()
     private_key = result[0]
-    private_key_n = int(private_key[1])
-    private_key_d = int(private_key[2])
+    return int(private_key[1]), int(private_key[2])
+
+
+def sign(number_to_sign, private_key=None):
+    private_key_n, private_key_d = private_key or reader_private_key()
 
     # Hash the number to sign and create a digital signature
     msg = bytes(str(number_to_sign), 'utf-8')
@@ -57,14 +88,193 @@ def send(msg):
     if len(receive) != 0:
         if receive.startswith('Number to sign:'):
             # Insert handshake number into the database
-            x.execute("INSERT OR IGNORE INTO handshake_number VALUES (?,?,?,?)",
-                      (str(process_instance_id), reader_address, authority, receive[16:]))
-            connection.commit()
+            store_number_to_sign(authority, receive[16:])
             return True
         # Insert generated description keys into the database
-        x.execute("INSERT OR IGNORE INTO authorities_generated_decription_keys VALUES (?,?,?,?)",
-                  (str(process_instance_id), reader_address, authority, receive[23:]))
-        connection.commit()
+        store_partial_key(authority, receive[23:])
+
+
+def request_key(tls_conn, frame_reader, authority_name, private_key, process_instance_id):
+    # Handshake and key request with binary frames: the number to sign is only kept in memory,
+    # and the connection stays open for further requests
+    tls_conn.sendall(wire_protocol.pack_frame(wire_protocol.KEY_REQUEST,
+                                              wire_protocol.pack_fields(str(process_instance_id), reader_address)))
+    message_type, payload = frame_reader.read_frame()
+    if message_type != wire_protocol.NUMBER_TO_SIGN:
+        raise Exception(f"{authority_name}: {wire_protocol.unpack_fields(payload)}")
+    signature_sending = sign(wire_protocol.unpack_fields(payload)[0], private_key)
+    tls_conn.sendall(wire_protocol.pack_frame(wire_protocol.SIGNED_KEY_REQUEST, wire_protocol.pack_fields(
+        gid, str(process_instance_id), reader_address, str(signature_sending))))
+    message_type, payload = frame_reader.read_frame()
+    if message_type != wire_protocol.PARTIAL_KEY:
+        raise Exception(f"{authority_name}: {wire_protocol.unpack_fields(payload)}")
+    # Stored in the serialized form the reader expects
+    return objectToBytes(wire_protocol.decode_key(groupObj, payload), groupObj).decode('utf-8')
+
+
+def request_keys_batch(tls_conn, frame_reader, authority_name, private_keys, process_instance_id):
+    # Batch handshake and key request for many readers, identified by their addresses: one frame with the
+    # numbers to sign of all of them, one with all the signatures, then a key or an error per reader
+    readers = list(private_keys)
+    tls_conn.sendall(wire_protocol.pack_frame(wire_protocol.BATCH_KEY_REQUEST,
+                                              wire_protocol.pack_fields(str(process_instance_id), *readers)))
+    message_type, payload = frame_reader.read_frame()
+    if message_type != wire_protocol.BATCH_NUMBERS_TO_SIGN:
+        raise Exception(f"{authority_name}: {wire_protocol.unpack_fields(payload)}")
+    fields = wire_protocol.unpack_fields(payload)
+    signatures = []
+    for address, number_to_sign in zip(fields[0::2], fields[1::2]):
+        signatures += [address, str(sign(number_to_sign, private_keys[address]))]
+    tls_conn.sendall(wire_protocol.pack_frame(wire_protocol.BATCH_SIGNED_KEY_REQUEST,
+                                              wire_protocol.pack_fields(str(process_instance_id), *signatures)))
+    keys, errors = {}, {}
+    while True:
+        message_type, payload = frame_reader.read_frame()
+        if message_type == wire_protocol.BATCH_END:
+            return keys, errors
+        if message_type == wire_protocol.BATCH_KEY:
+            address, key = wire_protocol.unpack_fields(payload, decode=False)
+            keys[address.decode('utf-8')] = objectToBytes(wire_protocol.decode_key(groupObj, key), groupObj).decode('utf-8')
+        elif message_type == wire_protocol.ERROR:
+            fields = wire_protocol.unpack_fields(payload)
+            if len(fields) < 2:
+                raise Exception(f"{authority_name}: {fields[0]}")
+            errors[fields[1]] = fields[0]
+        else:
+            raise Exception(f"{authority_name}: unexpected frame in the batch reply")
+
+
+def store_keys(keys, process_instance_id, address=None):
+    # Insert generated description keys into the database, all in one transaction
+    with connection:
+        connection.executemany("INSERT OR IGNORE INTO authorities_generated_decription_keys VALUES (?,?,?,?)",
+                               [(str(process_instance_id), address or reader_address, authority_name, key)
+                                for authority_name, key in keys.items()])
+
+
+class AuthorityConnectionPool:
+    """
+    Long-lived connections of the reader to the Authorities, one per Authority, reused across key requests.
+    A connection that has to be re-established resumes the last TLS session with that Authority.
+    """
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.connections = {}
+        self.sessions = {}
+        self.locks = {number: threading.Lock() for number in range(1, len(authorities_names()) + 1)}
+
+    def connect(self, authority_number):
+        s = socket.create_connection((SERVER, 5080 + authority_number - 1), timeout=self.timeout)
+        tls_conn = context.wrap_socket(s, server_side=False, server_hostname=server_sni_hostname,
+                                       session=self.sessions.get(authority_number))
+        return tls_conn, wire_protocol.FrameReader(tls_conn)
+
+    def discard(self, authority_number):
+        tls_conn, _ = self.connections.pop(authority_number, (None, None))
+        if tls_conn is not None:
+            try:
+                tls_conn.close()
+            except OSError:
+                pass
+
+    def attempt(self, authority_number, request, *request_args):
+        # Run a request on the connection to the Authority, opening it if needed
+        if authority_number not in self.connections:
+            self.connections[authority_number] = self.connect(authority_number)
+        tls_conn, frame_reader = self.connections[authority_number]
+        try:
+            result = request(tls_conn, frame_reader, 'Auth-' + str(authority_number), *request_args)
+        except Exception:
+            # Replies of the failed request may still be unread, the connection can not be reused
+            self.discard(authority_number)
+            raise
+        # Kept after a successful exchange, when the session tickets have been received
+        self.sessions[authority_number] = tls_conn.session
+        return result
+
+    def exchange(self, authority_number, request, *request_args):
+        # A pooled connection closed by the Authority while idle is replaced at once by a new one,
+        # only a failure on a new connection is reported to the caller
+        with self.locks[authority_number]:
+            pooled = authority_number in self.connections
+            try:
+                return self.attempt(authority_number, request, *request_args)
+            except (ConnectionError, ssl.SSLEOFError):
+                if not pooled:
+                    raise
+            return self.attempt(authority_number, request, *request_args)
+
+    def request_key(self, authority_number, private_key, process_instance_id):
+        return self.exchange(authority_number, request_key, private_key, process_instance_id)
+
+    def request_keys_batch(self, authority_number, private_keys, process_instance_id):
+        return self.exchange(authority_number, request_keys_batch, private_keys, process_instance_id)
+
+    def close(self):
+        for authority_number in list(self.connections):
+            try:
+                self.connections[authority_number][0].sendall(wire_protocol.pack_frame(wire_protocol.DISCONNECT))
+            except OSError:
+                pass
+            self.discard(authority_number)
+
+
+def acquire(request, authority_number, retries, *request_args):
+    # Run a request of the pool to an Authority, retrying on network errors, timeouts and
+    # malformed replies. An ERROR reply of the Authority is final and raised at once
+    for attempt in range(retries + 1):
+        try:
+            return request(authority_number, *request_args)
+        except (OSError, ValueError) as e:
+            if attempt == retries:
+                raise Exception(f"Auth-{authority_number}: {e}")
+            time.sleep(2 ** attempt)
+
+
+def acquire_key(pool, authority_number, private_key, process_instance_id, retries):
+    # Request the key of an Authority on its pooled connection
+    return acquire(pool.request_key, authority_number, retries, private_key, process_instance_id)
+
+
+def acquire_keys(pool, authority_numbers, process_instance_id, retries):
+    # Request the keys of the Authorities concurrently and store the ones received together
+    private_key = reader_private_key()
+    keys, errors = {}, {}
+    with ThreadPoolExecutor(max_workers=max(1, len(authority_numbers))) as executor:
+        futures = {number: executor.submit(acquire_key, pool, number, private_key, process_instance_id, retries)
+                   for number in authority_numbers}
+        for number, future in futures.items():
+            try:
+                keys['Auth-' + str(number)] = future.result()
+            except Exception as e:
+                errors['Auth-' + str(number)] = str(e)
+    store_keys(keys, process_instance_id)
+    return keys, errors
+
+
+def acquire_keys_batch(pool, authority_numbers, requester_names, process_instance_id, retries):
+    # Request the keys of many readers from the Authorities concurrently, one batch per Authority,
+    # and store the keys of every reader in one transaction
+    private_keys = {}
+    for requester_name in requester_names:
+        address = config(requester_name + '_ADDRESS')
+        private_keys[address] = reader_private_key(address)
+    keys, errors = {address: {} for address in private_keys}, {}
+    with ThreadPoolExecutor(max_workers=max(1, len(authority_numbers))) as executor:
+        futures = {number: executor.submit(acquire, pool.request_keys_batch, number, retries, private_keys, process_instance_id)
+                   for number in authority_numbers}
+        for number, future in futures.items():
+            try:
+                authority_keys, authority_errors = future.result()
+            except Exception as e:
+                authority_keys, authority_errors = {}, {address: str(e) for address in private_keys}
+            for address, key in authority_keys.items():
+                keys[address]['Auth-' + str(number)] = key
+            for address, error in authority_errors.items():
+                errors[(address, 'Auth-' + str(number))] = error
+    for address, reader_keys in keys.items():
+        store_keys(reader_keys, process_instance_id, address)
+    return keys, errors
 
 
 if __name__ == '__main__':
@@ -75,6 +285,8 @@ if __name__ == '__main__':
     connection = sqlite3.connect('../databases/reader/reader.db')
     x = connection.cursor()
 
+    groupObj = PairingGroup('SS512')
+
     # Load environment variables and configurations
     process_instance_id_env = config('PROCESS_INSTANCE_ID')
     process_instance_id = int(process_instance_id_env)
@@ -93,17 +305,65 @@ if __name__ == '__main__':
     parser.add_argument('-a', '--authority', type=int, help='Authority number')
     parser.add_argument('-hs', '--handshake', action='store_true', help='Handshake request')
     parser.add_argument('-gk', '--generate_key', action='store_true', help='Generate key request')
+    parser.add_argument('-k', '--key', action='store_true', help='Handshake and key request on a single connection')
+    parser.add_argument('-A', '--all_authorities', action='store_true', help='Request the keys of all the Authorities concurrently')
+    parser.add_argument('-t', '--timeout', type=float, default=30, help='Timeout of a connection to an Authority, in seconds')
+    parser.add_argument('--retries', type=int, default=2, help='Retries of a failed key request to an Authority')
+    parser.add_argument('-p', '--process_instances', type=int, nargs='+', help='Process instances to request the keys of, on the same connections')
+    parser.add_argument('-B', '--batch_requesters', type=str, nargs='+', help='Requester names whose keys are requested in one batch per Authority')
     args = parser.parse_args()
 
-    # Determine Authority address and port
-    PORT = 5080 + args.authority - 1
     SERVER = config('SERVER_ADDRESS')
-    ADDR = (SERVER, PORT)
+
+    # Create SSL context for secure connection
+    context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH, cafile=server_cert)
+    context.load_cert_chain(certfile=client_cert, keyfile=client_key)
+
+    if args.batch_requesters:
+        # Onboarding of many readers, with the Authority given or all of them
+        authority_numbers = [args.authority] if args.authority else list(range(1, len(authorities_names()) + 1))
+        pool = AuthorityConnectionPool(args.timeout)
+        failed = False
+        for instance in args.process_instances or [process_instance_id]:
+            keys, errors = acquire_keys_batch(pool, authority_numbers, args.batch_requesters, instance, args.retries)
+            for address, reader_keys in keys.items():
+                print(f"✅ {len(reader_keys)} keys generated for {address}, process instance {instance}")
+            for (address, authority_name), error in errors.items():
+                print(f"❌ Key generation failed for {address} by {authority_name}, process instance {instance}: {error}")
+            failed = failed or bool(errors)
+        pool.close()
+        if failed:
+            exit(1)
+        exit()
 
     # Retrieve sender and reader addresses
     sender_address = config(args.requester_name + '_ADDRESS')
     gid = sender_address
     reader_address = sender_address
+
+    if args.all_authorities:
+        pool = AuthorityConnectionPool(args.timeout)
+        failed = False
+        for instance in args.process_instances or [process_instance_id]:
+            # Request only the keys not already present
+            x.execute("SELECT authority_name FROM authorities_generated_decription_keys WHERE process_instance=? AND reader_address=?",
+                      (str(instance), reader_address))
+            present = set(row[0] for row in x.fetchall())
+            missing = [number for number in range(1, len(authorities_names()) + 1) if 'Auth-' + str(number) not in present]
+            keys, errors = acquire_keys(pool, missing, instance, args.retries)
+            for authority_name in keys:
+                print(f"✅ Key generation completed for {authority_name}, process instance {instance} and requester {args.requester_name}!")
+            for authority_name, error in errors.items():
+                print(f"❌ Key generation failed for {authority_name}, process instance {instance}: {error}")
+            failed = failed or bool(errors)
+        pool.close()
+        if failed:
+            exit(1)
+        exit()
+
+    # Determine Authority address and port
+    PORT = 5080 + args.authority - 1
+    ADDR = (SERVER, PORT)
     authority = 'Auth-' + str(args.authority)
 
     # Check if a key is already present for the given Authority
@@ -111,14 +371,10 @@ if __name__ == '__main__':
                   (str(process_instance_id), authority, reader_address))
     result = x.fetchall()
     if result:
-        if args.generate_key:
+        if args.generate_key or args.key:
             print(f"✅ Key already present for {authority}!")
         exit()
 
-    # Create SSL context for secure connection
-    context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH, cafile=server_cert)
-    context.load_cert_chain(certfile=client_cert, keyfile=client_key)
-
     # Create a socket and wrap it with SSL
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     conn = context.wrap_socket(s, server_side=False, server_hostname=server_sni_hostname)
@@ -134,4 +390,9 @@ if __name__ == '__main__':
             authority + " - Generate your part of my key§" + gid + '§' + str(process_instance_id) + '§' + reader_address
             + '§' + str(signature_sending))
         print(f"✅ Key generation completed for {authority} and requester {args.requester_name}!")
+    elif args.key:
+        store_keys({authority: request_key(conn, wire_protocol.FrameReader(conn), authority, reader_private_key(), process_instance_id)},
+                   process_instance_id)
+        conn.sendall(wire_protocol.pack_frame(wire_protocol.DISCONNECT))
+        print(f"✅ Handshake and key generation completed for {authority} and requester {args.requester_name}!")
 
@@ -1,19 +1,22 @@
 import os
+import contextlib
 from charm.toolbox.pairinggroup import *
 from charm.core.engine.util import objectToBytes, bytesToObject
-import cryptocode
 import block_int
 from decouple import config
 import ipfshttpclient
 import json
 from maabe_class import *
+from hash_cache import hash_cache
 from datetime import datetime
 import random
-import base64
+import tempfile
 import sqlite3
 import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from authorities_info import authorities_names_and_addresses
 from policy_plus import policy_plus
+from symmetric_crypto import derive_key, write_slice
 
 def retrieve_data(authority_address, process_instance_id):
     """Retrieve names, public parameters, and public keys from the specified Authority"""
@@ -22,65 +25,173 @@ def retrieve_data(authority_address, process_instance_id):
     public_key = block_int.retrieve_publicKey_link(authority_address, process_instance_id)
     return authorities, public_parameters, public_key
 
-def generate_pp_pk(process_instance_id):
-    """Generate public parameters and public keys for the Authorities"""
-    check_authorities = []
-    check_parameters = []
-    for authority_name, authority_address in authorities_names_and_addresses:
-        data = retrieve_data(authority_address, process_instance_id)
-        check_authorities.append(data[0])
-        check_parameters.append(data[1])
-        pk1 = api.cat(data[2])
-        pk1 = pk1.decode('utf-8').rstrip('"').lstrip('"').encode('utf-8')
-        x.execute("INSERT OR IGNORE INTO authorities_public_keys VALUES (?,?,?,?)",
-                  (str(process_instance_id), f"Auth-{authority_name[4:]}", data[2], pk1))
-        conn.commit()
-    if len(set(check_authorities)) == 1 and len(set(check_parameters)) == 1:
-        getfile = api.cat(check_parameters[0])
+class DataOwnerContext:
+    """
+    Public parameters and Authority public keys of a process instance, loaded from the database,
+    deserialized and precomputed once and kept in memory. The chain and IPFS are only used when
+    the values are missing from the database or, on validation, when the on-chain links changed.
+    """
+
+
+    def __init__(self, groupObj, maabe, api, conn, authorities, process_instance_id):
+        self.groupObj = groupObj
+        self.maabe = maabe
+        self.api = api
+        self.conn = conn
+        self.authorities = authorities
+        self.process_instance_id = str(process_instance_id)
+        self.links = None
+        self.public_parameters = None
+        self.public_parameters_bytes = None
+        self.pk = None
+        self.pk_bytes = None
+
+
+    def stored(self):
+        # Links and serialized values in the database, None if something is missing
+        x = self.conn.cursor()
+        x.execute("SELECT * FROM public_parameters WHERE process_instance=?", (self.process_instance_id,))
+        result = x.fetchall()
+        if not result:
+            return None
+        links = [result[0][1]]
+        public_parameters_bytes = result[0][2]
+        pk_bytes = {}
+        for authority_name, authority_address in self.authorities:
+            x.execute("SELECT * FROM authorities_public_keys WHERE process_instance=? AND authority_name=?",
+                      (self.process_instance_id, f"Auth-{authority_name[4:]}"))
+            result = x.fetchall()
+            if not result:
+                return None
+            links.append(result[0][2])
+            pk_bytes[authority_name] = result[0][3]
+        return tuple(links), public_parameters_bytes, pk_bytes
+
+
+    def chain_links(self):
+        # Links published on chain by the Authorities: the public parameters, then the public keys
+        check_authorities = []
+        check_parameters = []
+        pk_links = []
+        for authority_name, authority_address in self.authorities:
+            data = retrieve_data(authority_address, self.process_instance_id)
+            check_authorities.append(data[0])
+            check_parameters.append(data[1])
+            pk_links.append(data[2])
+        if len(set(check_authorities)) != 1 or len(set(check_parameters)) != 1:
+            raise Exception("The Authorities do not agree on the public parameters")
+        return tuple([check_parameters[0]] + pk_links)
+
+
+    def fetch(self, links):
+        # Download the values of the on-chain links from IPFS and store them in the database
+        x = self.conn.cursor()
+        for (authority_name, authority_address), link in zip(self.authorities, links[1:]):
+            pk1 = self.api.cat(link)
+            pk1 = pk1.decode('utf-8').rstrip('"').lstrip('"').encode('utf-8')
+            x.execute("INSERT OR REPLACE INTO authorities_public_keys VALUES (?,?,?,?)",
+                      (self.process_instance_id, f"Auth-{authority_name[4:]}", link, pk1))
+        getfile = self.api.cat(links[0])
         getfile = getfile.decode('utf-8').rstrip('"').lstrip('"').encode('utf-8')
-        x.execute("INSERT OR IGNORE INTO public_parameters VALUES (?,?,?)",
-                  (str(process_instance_id), check_parameters[0], getfile))
-        conn.commit()
-
-def retrieve_public_parameters(process_instance_id):
-    """Retrieve public parameters for the specified process instance"""
-    x.execute("SELECT * FROM public_parameters WHERE process_instance=?", (str(process_instance_id),))
-    result = x.fetchall()
-    if not result:
-        return None
-    public_parameters = result[0][2]
-    return public_parameters
-
-def file_to_base64(file_path):
-    """Encode a file to Base64 format"""
-    try:
-        with open(file_path, 'rb') as file:
-            encoded = base64.b64encode(file.read()).decode('utf-8')
-        return encoded
-    except Exception as e:
-        print(f"Error encoding file to Base64: {e}")
-        return None
-
-def cipher_data(groupObj, maabe, api, process_instance_id, sender_name, input_files_path, policies_path, function, caseID):
-    """Encrypt data using MA-ABE and generate a corresponding IPFS hash"""
+        x.execute("INSERT OR REPLACE INTO public_parameters VALUES (?,?,?)",
+                  (self.process_instance_id, links[0], getfile))
+        self.conn.commit()
+
+
+    def load(self, validate=False):
+        """
+        Make the public parameters and public keys available, doing only the work needed.
+        :param validate: If True compare the stored links with the on-chain ones, and refresh the values if they changed.
+        :return: The context.
+        """
+        stored = self.stored()
+        if stored is None or validate:
+            links = self.chain_links()
+            if stored is None or stored[0] != links:
+                self.fetch(links)
+                stored = self.stored()
+        links, public_parameters_bytes, pk_bytes = stored
+        if links == self.links:
+            return self
+        public_parameters = bytesToObject(public_parameters_bytes, self.groupObj)
+        public_parameters["H"] = hash_cache(self.groupObj).hash
+        public_parameters["F"] = hash_cache(self.groupObj).hash
+        pk = {authority_name: bytesToObject(pk1, self.groupObj) for authority_name, pk1 in pk_bytes.items()}
+        self.maabe.precompute(public_parameters, pk)
+        self.public_parameters, self.public_parameters_bytes = public_parameters, public_parameters_bytes
+        self.pk, self.pk_bytes = pk, pk_bytes
+        self.links = links
+        return self
+
+
+# Contexts of the process instances used by this process
+contexts = {}
+
+def data_owner_context(groupObj, maabe, api, conn, process_instance_id, validate=False):
+    """Return the loaded context of the process instance, reusing the one in memory"""
+    context = contexts.get(str(process_instance_id))
+    if context is None:
+        context = contexts[str(process_instance_id)] = DataOwnerContext(
+            groupObj, maabe, api, conn, authorities_names_and_addresses, process_instance_id)
+    return context.load(validate)
+
+def encrypt_slice(api, file_path, key_material, ciphered_key):
+    """Write the slice object of a file (ciphered key and chunked encryption) into a temporary file and add it to IPFS"""
+    with open(file_path, 'rb') as source, tempfile.NamedTemporaryFile(suffix='.cgs') as destination:
+        write_slice(key_material, ciphered_key, source, destination)
+        destination.flush()
+        return api.add(destination.name)['Hash']
+
+# Objects used by the encryption tasks, in the worker processes or in the current process
+worker_context = {}
+
+def init_encryption_worker(public_parameters_bytes, pk_bytes):
+    """Build the group, the MA-ABE scheme and the precomputed parameters of an encryption worker process"""
+    groupObj = PairingGroup('SS512')
+    maabe = MaabeRW15(groupObj)
+    public_parameters = bytesToObject(public_parameters_bytes, groupObj)
+    public_parameters["H"] = hash_cache(groupObj).hash
+    public_parameters["F"] = hash_cache(groupObj).hash
+    pk = {authority_name: bytesToObject(pk1, groupObj) for authority_name, pk1 in pk_bytes.items()}
+    maabe.precompute(public_parameters, pk)
+    api = ipfshttpclient.connect('/ip4/127.0.0.1/tcp/5001')
+    worker_context.update(group=groupObj, maabe=maabe, public_parameters=public_parameters, pk=pk, api=api)
+
+def encryption_executor(groupObj, maabe, api, public_parameters, pk, public_parameters_bytes, pk_bytes, workers):
+    """Return the executor of the encryption tasks: a pool of worker processes, or the current process if workers is 1"""
+    if workers > 1:
+        return ProcessPoolExecutor(max_workers=workers, initializer=init_encryption_worker,
+                                   initargs=(public_parameters_bytes, pk_bytes))
+    worker_context.update(group=groupObj, maabe=maabe, public_parameters=public_parameters, pk=pk, api=api)
+    return ThreadPoolExecutor(max_workers=1)
+
+def encapsulation_task(policy):
+    """Encrypt a fresh GT key under the access policy, return the serialized key and the serialized ciphertext"""
+    groupObj = worker_context['group']
+    key_group = groupObj.random(GT)
+    ciphered_key = worker_context['maabe'].encrypt(worker_context['public_parameters'], worker_context['pk'], key_group, policy)
+    return groupObj.serialize(key_group), objectToBytes(ciphered_key, groupObj).decode('utf-8')
+
+def encryption_task(task):
+    """Encrypt a file into its slice object and return the IPFS link of the slice"""
+    file_path, key_material, ciphered_key = task
+    return encrypt_slice(worker_context['api'], file_path, key_material, ciphered_key)
+
+def cipher_data(groupObj, maabe, api, process_instance_id, sender_name, input_files_path, policies_path, function, caseID, key_per_policy=False, workers=1, validate=False, executor=None):
+    """Encrypt data using MA-ABE and generate a corresponding IPFS hash.
+    Every file becomes its own IPFS slice object, and the message is a manifest listing the
+    slices with their policy, attributes and link, so a reader only downloads the manifest and its slices.
+    With key_per_policy, files sharing an access policy share one ABE key encapsulation, stored once in
+    its own IPFS object linked by the slices as KeyLink, and each file key is derived from it and the slice id.
+    With more than one worker, key encapsulations and file encryptions run in a pool of processes.
+    With validate, the stored public parameters and keys are checked against the on-chain links.
+    An executor built for the same public parameters and keys is used instead of a new one, and left open.
+    Return the IPFS hash of the message"""
     global message_id
     sender_address = config(sender_name + '_ADDRESS')
     sender_private_key = config(sender_name + '_PRIVATEKEY')
-    generate_pp_pk(process_instance_id)
-    response = retrieve_public_parameters(process_instance_id)
-    public_parameters = bytesToObject(response, groupObj)
-    H = lambda x: groupObj.hash(x, G2)
-    F = lambda x: groupObj.hash(x, G2)
-    public_parameters["H"] = H
-    public_parameters["F"] = F
-    pk = {}
-    for authority_name, authority_address in authorities_names_and_addresses:
-        x.execute("SELECT * FROM authorities_public_keys WHERE process_instance=? AND authority_name=?",
-                  (str(process_instance_id), f"Auth-{authority_name[4:]}"))
-        result = x.fetchall()
-        pk1 = result[0][3]
-        pk1 = bytesToObject(pk1, groupObj)
-        pk[authority_name] = pk1
+    context = data_owner_context(groupObj, maabe, api, conn, process_instance_id, validate)
+    public_parameters, pk = context.public_parameters, context.pk
     
     # Load input files and policies
     input_files_path = os.path.abspath(input_files_path)
@@ -90,40 +201,26 @@ def cipher_data(groupObj, maabe, api, process_instance_id, sender_name, input_fi
     for policy in input_policies:
         new_policy = policy_plus(input_policies[policy], len(authorities_names_and_addresses))
         input_policies[policy] = new_policy
-    file_contents = {}
     access_policy = {}
     
-    # Convert files to Base64 and prepare access policies
+    # Prepare access policies
     for file_name, policy in input_policies.items():
-        file_path = os.path.join(input_files_path, file_name)
-        file_contents[file_name] = file_to_base64(file_path)
-        temporal = "".join(f"{process_instance_id_env}@{authority_name} and " for authority_name, _ in authorities_names_and_addresses)
+        temporal = "".join(f"{process_instance_id}@{authority_name} and " for authority_name, _ in authorities_names_and_addresses)
         access_policy[file_name] = f"({temporal[:-5]}) and {policy}"
     
-    keys = []
     header = []
+    shared_keys = []
+    encapsulation_policies = []
+    encapsulation_index = {}
+    key_indexes = []
     
     # Clear cache file
     with open('../src/.cache', 'w') as file:
         pass
     
-    # Encrypt files and generate headers
+    # Generate the slice entries of the manifest
     for index, (file_name, policy) in enumerate(input_policies.items()):
-        key_group = groupObj.random(GT)
-        key_encrypt = groupObj.serialize(key_group)
-        keys.append(key_encrypt)
-        key_encrypt_deser = groupObj.deserialize(key_encrypt)
-        ciphered_key = maabe.encrypt(public_parameters, pk, key_encrypt_deser, access_policy[file_name])
-        ciphered_key_bytes = objectToBytes(ciphered_key, groupObj)
-        ciphered_key_bytes_string = ciphered_key_bytes.decode('utf-8')
-        
-        # Encrypt file contents and prepare headers
-        cipher = cryptocode.encrypt(file_contents[file_name], str(keys[index]))
-        dict_pol = {
-            'CipheredKey': ciphered_key_bytes_string,
-            'FileName': file_name,
-            'EncryptedFile': cipher
-        }
+        dict_pol = {'FileName': file_name}
         
         # Handle multiple policies with slice ID
         if len(access_policy) > 1:
@@ -135,7 +232,44 @@ def cipher_data(groupObj, maabe, api, process_instance_id, sender_name, input_fi
             with open('../src/.cache', 'a') as file:
                 file.write(f'slice id {file_name}: {slice_id} | slice{index + 1}\n')
         
+        # One key encapsulation per file, or per distinct policy when the encapsulation is shared
+        if key_per_policy:
+            normalized_policy = maabe.compiler.normalize(access_policy[file_name])
+            if normalized_policy not in encapsulation_index:
+                encapsulation_index[normalized_policy] = len(encapsulation_policies)
+                encapsulation_policies.append(normalized_policy)
+            key_indexes.append(encapsulation_index[normalized_policy])
+        else:
+            key_indexes.append(len(encapsulation_policies))
+            encapsulation_policies.append(access_policy[file_name])
+        dict_pol['Policy'] = access_policy[file_name]
+        # Attributes of the policy, to let readers skip the slices they can not open
+        compiled_policy = maabe.compiler.compile(access_policy[file_name], normalize=False)
+        dict_pol['Attributes'] = sorted(set(leaf.getAttribute() for leaf in maabe.util.leaves(compiled_policy.tree)))
         header.append(dict_pol)
+    
+    # Encrypt the keys, then the files, keeping the slices in the original order
+    if executor is None:
+        executor = encryption_executor(groupObj, maabe, api, public_parameters, pk, context.public_parameters_bytes, context.pk_bytes, workers)
+    else:
+        executor = contextlib.nullcontext(executor)
+    with executor as executor:
+        encapsulations = list(executor.map(encapsulation_task, encapsulation_policies))
+        if key_per_policy:
+            shared_keys = [api.add_bytes(ciphered_key.encode('utf-8')) for _, ciphered_key in encapsulations]
+        encryption_tasks = []
+        for dict_pol, key_index in zip(header, key_indexes):
+            file_key, ciphered_key = encapsulations[key_index]
+            if key_per_policy:
+                dict_pol['KeyLink'] = shared_keys[key_index]
+                file_key = derive_key(file_key, dict_pol.get('Slice_id', dict_pol['FileName']))
+                ciphered_key = b''
+            else:
+                ciphered_key = ciphered_key.encode('utf-8')
+            encryption_tasks.append((os.path.join(input_files_path, dict_pol['FileName']), file_key, ciphered_key))
+        for dict_pol, link in zip(header, executor.map(encryption_task, encryption_tasks)):
+            dict_pol['Link'] = link
+    print(hash_cache(groupObj))
 
     if caseID is None:
         # Generate metadata and send to IPFS
@@ -149,7 +283,7 @@ def cipher_data(groupObj, maabe, api, process_instance_id, sender_name, input_fi
         }
         print(f'message id: {message_id}')
 
-        json_total = {'metadata': metadata, 'header': header}
+        json_total = {'metadata': metadata, 'slices': header}
         hash_file = api.add_json(json_total)
         print(f'ipfs hash: {hash_file}')
 
@@ -161,7 +295,7 @@ def cipher_data(groupObj, maabe, api, process_instance_id, sender_name, input_fi
         }
         print(f'case id: {int(caseID)}')
 
-        json_total = {'metadata': metadata, 'header': header}
+        json_total = {'metadata': metadata, 'slices': header}
         hash_file = api.add_json(json_total)
         print(f'ipfs hash: {hash_file}')
 
@@ -182,6 +316,7 @@ def cipher_data(groupObj, maabe, api, process_instance_id, sender_name, input_fi
         block_int.sendGuaranteeClaimGuarantor(sender_address, sender_private_key, int(caseID), hash_file)
     else:
         print("The function you specified is not supported.")
+    return hash_file
 
 
 if __name__ == '__main__':
@@ -198,10 +333,13 @@ if __name__ == '__main__':
     parser.add_argument('-p', '--policies', type=str, help='Path to the policies-file to load.')
     parser.add_argument('-f', '--function', type=str, help='Smart Contract function to call.')
     parser.add_argument('-c', '--case_id', type=str, help='CaseID of this practice')
+    parser.add_argument('-k', '--key_per_policy', action='store_true', help='Share one ABE key encapsulation among the files with the same policy')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='Number of worker processes encrypting the files')
+    parser.add_argument('-v', '--validate', action='store_true', help='Check the stored public parameters and keys against the chain')
     args = parser.parse_args()
     
     # Connection to SQLite3 data_owner database
     conn = sqlite3.connect('../databases/data_owner/data_owner.db')
     x = conn.cursor()
     authorities_names_and_addresses = authorities_names_and_addresses()
-    cipher_data(groupObj, maabe, api, process_instance_id, args.sender_name, args.input, args.policies, args.function, args.case_id)
+    cipher_data(groupObj, maabe, api, process_instance_id, args.sender_name, args.input, args.policies, args.function, args.case_id, args.key_per_policy, args.workers, args.validate)
@@ -0,0 +1,178 @@
+import hmac
+import json
+import queue
+import socket
+import sqlite3
+import argparse
+import ipaddress
+import threading
+import traceback
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from charm.toolbox.pairinggroup import PairingGroup
+from decouple import config
+import ipfshttpclient
+import data_owner
+from maabe_class import MaabeRW15
+from authorities_info import authorities_names_and_addresses
+
+"""
+Resident data owner service
+Accepts encryption jobs over a local HTTP API and runs them one at a time with cipher_data,
+keeping the pairing group, the public parameters, the IPFS client and the contract bindings warm
+
+POST /jobs        {"input": ..., "policies": ..., "sender_name": ..., "function": ..., "case_id": ...,
+                   "key_per_policy": false, "workers": 1, "validate": false, "process_instance_id": ...} -> {"job_id": ...}
+GET  /jobs/<id>   -> {"job_id": ..., "status": "queued" | "running" | "done" | "failed", ...}
+
+process_instance_id is optional, PROCESS_INSTANCE_ID by default: the job is encrypted with the public
+parameters of that process instance and its policies are bound to the attributes of that instance
+
+Every request carries "Authorization: Bearer <DATA_OWNER_SERVICE_TOKEN>" and the service only listens on
+a loopback address. With more than one worker the encryption processes are started with the service, for
+the public parameters of PROCESS_INSTANCE_ID, and shared by the jobs; the jobs of other process instances
+run with their own workers
+"""
+class DataOwnerService:
+    def __init__(self, token, database='../databases/data_owner/data_owner.db'):
+        self.token = token
+        self.database = database
+        self.executor = None
+        self.executor_parameters = None
+        self.jobs = {}
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.next_job_id = 1
+
+    # Validates a job request and queues it, returning the job id
+    def submit(self, request):
+        for field in ('input', 'policies', 'sender_name', 'function'):
+            if not request.get(field):
+                raise Exception(f"Missing job field: {field}")
+        with self.lock:
+            job_id = self.next_job_id
+            self.next_job_id += 1
+            self.jobs[job_id] = {'job_id': job_id, 'status': 'queued', 'submitted': datetime.now().isoformat()}
+        self.queue.put((job_id, request))
+        return job_id
+
+    def authorized(self, header):
+        return hmac.compare_digest((header or '').encode('utf-8'), f"Bearer {self.token}".encode('utf-8'))
+
+    def status(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def update(self, job_id, **values):
+        with self.lock:
+            self.jobs[job_id].update(values)
+
+    # Runs the queued jobs in order; the crypto objects and the database connection belong to this thread
+    def run_jobs(self):
+        groupObj = PairingGroup('SS512')
+        maabe = MaabeRW15(groupObj)
+        api = ipfshttpclient.connect('/ip4/127.0.0.1/tcp/5001')
+        data_owner.conn = sqlite3.connect(self.database)
+        data_owner.x = data_owner.conn.cursor()
+        while True:
+            job_id, request = self.queue.get()
+            self.update(job_id, status='running', started=datetime.now().isoformat())
+            try:
+                # A message id is only valid for the job that generated it
+                data_owner.message_id = None
+                process_instance_id = int(request.get('process_instance_id', data_owner.process_instance_id_env))
+                # Loaded, and validated if requested, before choosing the executor of the job
+                context = data_owner.data_owner_context(groupObj, maabe, api, data_owner.conn, process_instance_id,
+                                                        request.get('validate', False))
+                executor = None
+                if (context.public_parameters_bytes, context.pk_bytes) == self.executor_parameters:
+                    executor = self.executor
+                hash_file = data_owner.cipher_data(groupObj, maabe, api, process_instance_id, request['sender_name'],
+                                                   request['input'], request['policies'], request['function'],
+                                                   request.get('case_id'), request.get('key_per_policy', False),
+                                                   int(request.get('workers', 1)), False, executor)
+                self.update(job_id, status='done', ipfs_hash=hash_file, message_id=data_owner.message_id,
+                            finished=datetime.now().isoformat())
+            except Exception as e:
+                traceback.print_exc()
+                self.update(job_id, status='failed', error=str(e), finished=datetime.now().isoformat())
+
+    # Forks the encryption processes of the default process instance, loaded with a connection of this thread
+    def start_encryption_pool(self, workers):
+        groupObj = PairingGroup('SS512')
+        conn = sqlite3.connect(self.database)
+        try:
+            context = data_owner.DataOwnerContext(groupObj, MaabeRW15(groupObj), ipfshttpclient.connect('/ip4/127.0.0.1/tcp/5001'),
+                                                  conn, data_owner.authorities_names_and_addresses,
+                                                  data_owner.process_instance_id_env).load()
+        finally:
+            conn.close()
+        self.executor_parameters = (context.public_parameters_bytes, context.pk_bytes)
+        self.executor = ProcessPoolExecutor(max_workers=workers, initializer=data_owner.init_encryption_worker,
+                                            initargs=self.executor_parameters)
+        wait([self.executor.submit(int) for _ in range(workers)])
+
+    def start(self, host, port, workers=1):
+        if not ipaddress.ip_address(socket.gethostbyname(host)).is_loopback:
+            raise Exception(f"The data owner service only listens on a loopback address, not {host}")
+        data_owner.authorities_names_and_addresses = authorities_names_and_addresses()
+        data_owner.process_instance_id_env = config('PROCESS_INSTANCE_ID')
+        # The processes are forked before the threads of the service exist
+        if workers > 1:
+            self.start_encryption_pool(workers)
+        threading.Thread(target=self.run_jobs, daemon=True).start()
+        server = ThreadingHTTPServer((host, port), service_handler(self))
+        print(f"[LISTENING] Data owner service is listening on {host}:{port}")
+        server.serve_forever()
+
+
+def service_handler(service):
+    # Request handler bound to the service
+    class ServiceHandler(BaseHTTPRequestHandler):
+        def reply(self, code, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            if not service.authorized(self.headers.get('Authorization')):
+                return self.reply(401, {'error': 'Unauthorized'})
+            if self.path.rstrip('/') != '/jobs':
+                return self.reply(404, {'error': 'Not found'})
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                job_id = service.submit(json.loads(self.rfile.read(length) or b'{}'))
+            except Exception as e:
+                return self.reply(400, {'error': str(e)})
+            self.reply(202, {'job_id': job_id})
+
+        def do_GET(self):
+            if not service.authorized(self.headers.get('Authorization')):
+                return self.reply(401, {'error': 'Unauthorized'})
+            parts = self.path.strip('/').split('/')
+            if len(parts) != 2 or parts[0] != 'jobs' or not parts[1].isdigit():
+                return self.reply(404, {'error': 'Not found'})
+            job = service.status(int(parts[1]))
+            if job is None:
+                return self.reply(404, {'error': 'Unknown job'})
+            self.reply(200, job)
+
+    return ServiceHandler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Data owner encryption service')
+    parser.add_argument('-H', '--host', type=str, default='127.0.0.1', help='Loopback address to listen on')
+    parser.add_argument('-p', '--port', type=int, default=5070, help='Port to listen on')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='Encryption processes shared by the jobs of PROCESS_INSTANCE_ID')
+    args = parser.parse_args()
+    token = config('DATA_OWNER_SERVICE_TOKEN', default='')
+    if not token:
+        print("Set DATA_OWNER_SERVICE_TOKEN in the .env file to start the service")
+        exit()
+    DataOwnerService(token).start(args.host, args.port, args.workers)
@@ -0,0 +1,67 @@
+import threading
+from collections import OrderedDict
+from weakref import WeakKeyDictionary
+from charm.toolbox.pairinggroup import G2
+
+
+class HashCache:
+    """
+    Bounded LRU cache of the hashes to G2 of attributes and GIDs, with hit and miss counters.
+    It is shared by the threads of the servers and pools, the LRU order is updated under a lock.
+    """
+
+
+    def __init__(self, group, size=4096):
+        self.group = group
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+
+    def hash(self, value):
+        """
+        Hash a string to G2, reusing the element if the string was already hashed.
+        :param value: The attribute or GID to hash.
+        :return: The G2 element.
+        """
+        with self.lock:
+            element = self.entries.get(value)
+            if element is not None:
+                self.hits += 1
+                self.entries.move_to_end(value)
+                return element
+            self.misses += 1
+        # Hashed outside the lock, two threads missing the same value store the same element
+        element = self.group.hash(value, G2)
+        with self.lock:
+            self.entries[value] = element
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return element
+
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+    def __str__(self):
+        return f'hash cache: {self.hits} hits, {self.misses} misses, hit rate {self.hit_rate():.1%}'
+
+
+# Caches shared by all the users of a pairing group in this process, elements cannot be mixed between groups
+caches = WeakKeyDictionary()
+caches_lock = threading.Lock()
+
+
+def hash_cache(group):
+    """
+    Return the hash cache shared by every user of the pairing group
+    """
+    with caches_lock:
+        cache = caches.get(group)
+        if cache is None:
+            cache = caches[group] = HashCache(group)
+        return cache
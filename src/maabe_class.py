@@ -1,6 +1,8 @@
 from charm.toolbox.pairinggroup import *
-from charm.toolbox.secretutil import SecretUtil
 from charm.toolbox.ABEncMultiAuth import ABEncMultiAuth
+from policy_util import PolicyUtil
+from policy_compiler import PolicyCompiler
+from hash_cache import hash_cache
 import re
 
 
@@ -14,14 +16,14 @@ class MaabeRW15(ABEncMultiAuth):
     def __init__(self, group, verbose=False):
         ABEncMultiAuth.__init__(self)
         self.group = group
-        self.util = SecretUtil(group, verbose)
+        self.util = PolicyUtil(group, verbose)
+        self.compiler = PolicyCompiler(self.util)
+        self.hash = hash_cache(group).hash  # memoized hash to G2 of attributes and GIDs
 
 
     def setup(self, g1, g2):
         egg = pair(g1, g2)
-        H = lambda x: self.group.hash(x, G2)
-        F = lambda x: self.group.hash(x, G2)
-        gp = {'g1': g1, 'g2': g2, 'egg': egg, 'H': H, 'F': F}
+        gp = {'g1': g1, 'g2': g2, 'egg': egg, 'H': self.hash, 'F': self.hash}
         return gp
 
 
@@ -42,6 +44,34 @@ class MaabeRW15(ABEncMultiAuth):
         return parts[0], parts[1], None if len(parts) < 3 else parts[2]
 
 
+    def precompute(self, gp, pks=None):
+        """
+        Build the fixed-base exponentiation tables of the bases reused by authsetup and encrypt.
+        The tables are stored inside the group elements, so they are built once and then reused
+        by every call that receives the same gp and pks dictionaries.
+        :param gp: The global parameters.
+        :param pks: The public keys of the attribute authorities, as dict from authority name to public key.
+        """
+        bases = [gp['egg'], gp['g1']]
+        for pk in (pks or {}).values():
+            bases.extend([pk['egga'], pk['gy']])
+        for base in bases:
+            if not base.preproc:
+                base.initPP()
+
+
+    def precompute_authority(self, gp, sk):
+        """
+        Prepare the secret key of an attribute authority for repeated key generation: g2^alpha is
+        computed once and stored in sk, and the table of g1 is built. The extended sk must not be published.
+        :param gp: The global parameters.
+        :param sk: The secret key of the attribute authority.
+        """
+        sk['g2_alpha'] = gp['g2'] ** sk['alpha']
+        if not gp['g1'].preproc:
+            gp['g1'].initPP()
+
+
     def authsetup(self, gp, name):
         """
         Setup an attribute authority.
@@ -57,21 +87,34 @@ class MaabeRW15(ABEncMultiAuth):
         return pk, sk
 
 
-    def keygen(self, gp, sk, gid, attribute):
+    def user_base(self, gp, sk, gid):
+        """
+        Compute g2^alpha * H(GID)^y, the part of the secret key shared by all the attributes of a user.
+        :param gp: The global parameters.
+        :param sk: The secret key of the attribute authority, with g2^alpha if precompute_authority was called.
+        :param gid: The global user identifier.
+        :return: The G2 element.
+        """
+        g2_alpha = sk['g2_alpha'] if 'g2_alpha' in sk else gp['g2'] ** sk['alpha']
+        return g2_alpha * self.hash(gid) ** sk['y']
+
+
+    def keygen(self, gp, sk, gid, attribute, user_base=None):
         """
         Generate a user secret key for the attribute.
         :param gp: The global parameters.
         :param sk: The secret key of the attribute authority.
         :param gid: The global user identifier.
         :param attribute: The attribute.
+        :param user_base: The result of user_base for gid, computed if not given.
         :return: The secret key for the attribute for the user with identifier gid.
         """
         _, auth, _ = self.unpack_attribute(attribute)
         assert sk['name'] == auth, "Attribute %s does not belong to authority %s" % (attribute, sk['name'])
+        if user_base is None:
+            user_base = self.user_base(gp, sk, gid)
         t = self.group.random()
-        H = lambda x: self.group.hash(x, G2)
-        F = lambda x: self.group.hash(x, G2)
-        K = gp['g2'] ** sk['alpha'] * H(gid) ** sk['y'] * F(attribute) ** t
+        K = user_base * self.hash(attribute) ** t
         KP = gp['g1'] ** t
         return {'K': K, 'KP': KP}
 
@@ -86,29 +129,44 @@ class MaabeRW15(ABEncMultiAuth):
         :return: A dictionary with attribute names as keys, and secret keys for the attributes as values.
         """
         uk = {}
+        user_base = self.user_base(gp, sk, gid)
         for attribute in attributes:
-            uk[attribute] = self.keygen(gp, sk, gid, attribute)
+            uk[attribute] = self.keygen(gp, sk, gid, attribute, user_base)
         return uk
 
 
+    def multiple_users_keygen(self, gp, sk, users):
+        """
+        Generate the secret keys of many users, computing g2^alpha once for all of them.
+        The hashes of the attributes are shared through the hash cache.
+        :param gp: The global parameters.
+        :param sk: The secret key of the attribute authority.
+        :param users: A dictionary from global user identifier to the list of attributes of the user.
+        :return: A dictionary from global user identifier to the dictionary of secret keys of the user.
+        """
+        if 'g2_alpha' not in sk:
+            sk = dict(sk)
+            self.precompute_authority(gp, sk)
+        return {gid: self.multiple_attributes_keygen(gp, sk, gid, attributes) for gid, attributes in users.items()}
+
+
     def encrypt(self, gp, pks, message, policy_str):
         """
         Encrypt a message under an access policy
         :param gp: The global parameters.
         :param pks: The public keys of the relevant attribute authorities, as dict from authority name to public key.
         :param message: The message to encrypt.
-        :param policy_str: The access policy to use.
+        :param policy_str: The access policy to use, stored in the ciphertext in normalized form.
         :return: The encrypted message.
         """
         s = self.group.random()  # secret to be shared
         w = self.group.init(ZR, 0)  # 0 to be shared
-        policy = self.util.createPolicy(policy_str)
-        attribute_list = self.util.getAttributeList(policy)
-        secret_shares = self.util.calculateSharesDict(s, policy)  # These are correctly set to be exponents in Z_p
-        zero_shares = self.util.calculateSharesDict(w, policy)
+        policy = self.compiler.compile(policy_str)  # normalized, parsed and cached
+        attribute_list = policy.attributes
+        secret_shares = self.util.calculateSharesDict(s, policy.tree)  # These are correctly set to be exponents in Z_p
+        zero_shares = self.util.calculateSharesDict(w, policy.tree)
         C0 = message * (gp['egg'] ** s)
         C1, C2, C3, C4 = {}, {}, {}, {}
-        F = lambda x: self.group.hash(x, G2)
         for i in attribute_list:
             attribute_name, auth, _ = self.unpack_attribute(i)
             attr = "%s@%s" % (attribute_name, auth)
@@ -116,30 +174,39 @@ class MaabeRW15(ABEncMultiAuth):
             C1[i] = gp['egg'] ** secret_shares[i] * pks[auth]['egga'] ** tx
             C2[i] = gp['g1'] ** (-tx)
             C3[i] = pks[auth]['gy'] ** tx * gp['g1'] ** zero_shares[i]
-            C4[i] = F(attr) ** tx
-        return {'policy': policy_str, 'C0': C0, 'C1': C1, 'C2': C2, 'C3': C3, 'C4': C4}
+            C4[i] = self.hash(attr) ** tx
+        return {'policy': policy.policy, 'C0': C0, 'C1': C1, 'C2': C2, 'C3': C3, 'C4': C4}
 
 
-    def decrypt(self, gp, sk, ct):
+    def decrypt(self, gp, sk, ct, cheapest=True):
         """
         Decrypt the ciphertext using the secret keys of the user.
         :param gp: The global parameters.
         :param sk: The secret keys of the user.
         :param ct: The ciphertext to decrypt.
+        :param cheapest: If True decrypt with the satisfying attribute set with the fewest leaves, and therefore
+         the fewest pairings, otherwise with the first satisfying set found in the policy.
         :return: The decrypted message.
         :raise Exception: When the access policy can not be satisfied with the user's attributes.
         """
-        policy = self.util.createPolicy(ct['policy'])
-        coefficients = self.util.getCoefficients(policy)
-        pruned_list = self.util.prune(policy, sk['keys'].keys())
-        if not pruned_list:
+        policy = self.compiler.compile(ct['policy'], normalize=False)
+        selection = self.compiler.satisfying_set(policy, sk['keys'].keys(), cheapest)
+        if not selection:
             raise Exception("You don't have the required attributes for decryption!")
-        B = self.group.init(GT, 1)
-        for i in range(len(pruned_list)):
-            x = pruned_list[i].getAttribute()  # without the underscore
-            y = pruned_list[i].getAttributeAndIndex()  # with the underscore
-            H = lambda x: self.group.hash(x, G2)
-            B *= (ct['C1'][y] * pair(ct['C2'][y], sk['keys'][x]['K']) * pair(ct['C3'][y], H(sk['GID'])) * pair(
-                sk['keys'][x]['KP'], ct['C4'][y])) ** coefficients[y]
+        # By bilinearity e(C3_y, H(GID))^c_y multiply into a single pairing of the weighted C3 product,
+        # and the coefficients are moved into the G1 arguments of the remaining pairings
+        HGID = self.hash(sk['GID'])
+        C1_product, C3_product, left, right = None, None, [], []
+        for node, coefficient in selection:
+            x = node.getAttribute()  # without the underscore
+            y = node.getAttributeAndIndex()  # with the underscore
+            C1_term = ct['C1'][y] ** coefficient
+            C3_term = ct['C3'][y] ** coefficient
+            C1_product = C1_term if C1_product is None else C1_product * C1_term
+            C3_product = C3_term if C3_product is None else C3_product * C3_term
+            left.extend([ct['C2'][y] ** coefficient, sk['keys'][x]['KP'] ** coefficient])
+            right.extend([sk['keys'][x]['K'], ct['C4'][y]])
+        left.append(C3_product)
+        right.append(HGID)
+        B = C1_product * self.group.pair_prod(left, right)
         return ct['C0'] / B
-        
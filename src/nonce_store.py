@@ -0,0 +1,161 @@
+import time
+import contextlib
+import secrets
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+class NonceStore:
+    """
+    Numbers to sign of the pending handshakes, one per (process instance, reader), kept in memory.
+    A number expires after ttl seconds, is consumed by the first check of a valid signature, and the
+    oldest ones are dropped beyond size. With a database the table is mirrored to handshake_numbers,
+    with the expiry, by a background thread started with the first handshake, so handshakes only
+    wait for sqlite when more than max_pending changes are queued.
+    """
+
+
+    def __init__(self, ttl=300, size=100000, database=None, flush_interval=1.0, max_pending=10000):
+        self.ttl = ttl
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.database = database
+        self.pending = OrderedDict()
+        self.max_pending = max_pending
+        self.flush_interval = flush_interval
+        self.writer = None
+        self.write_lock = threading.Lock()
+        if database is not None:
+            self.load()
+
+
+    def load(self):
+        # Only the numbers not expired survive a restart. Rows without an expiry were written before
+        # it was persisted and may have been used already, they are dropped
+        connection = sqlite3.connect(self.database)
+        columns = [row[1] for row in connection.execute("PRAGMA table_info(handshake_numbers)")]
+        with connection:
+            if 'expires' not in columns:
+                connection.execute("ALTER TABLE handshake_numbers ADD COLUMN expires REAL")
+            connection.execute("DELETE FROM handshake_numbers WHERE expires IS NULL OR expires < ?", (time.time(),))
+        for process_instance_id, reader_address, number_to_sign, expires in connection.execute(
+                "SELECT process_instance, reader_address, handshake_number, expires FROM handshake_numbers ORDER BY expires"):
+            self.entries[(process_instance_id, reader_address)] = (number_to_sign, expires)
+        connection.close()
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+    def issue(self, process_instance_id, reader_address):
+        """
+        Generate the number to sign of a handshake, replacing the pending one of the same reader.
+        :return: The number to sign.
+        """
+        key = (str(process_instance_id), reader_address)
+        number_to_sign = str(secrets.randbelow(2 ** 64) + 1)
+        expires = time.time() + self.ttl
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (number_to_sign, expires)
+            if len(self.entries) > self.size:
+                evicted, _ = self.entries.popitem(last=False)
+                self.record('delete', evicted)
+            self.record('insert', key, (number_to_sign, expires))
+        self.throttle()
+        return number_to_sign
+
+
+    def number(self, process_instance_id, reader_address):
+        """
+        Return the number to sign of a pending handshake, leaving it pending.
+        :return: The number, or None if there is none or it expired.
+        """
+        key = (str(process_instance_id), reader_address)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] < time.time():
+                del self.entries[key]
+                self.record('delete', key)
+                entry = None
+        self.throttle()
+        return entry[0] if entry is not None else None
+
+
+    def consume(self, process_instance_id, reader_address, number_to_sign):
+        """
+        Remove the number of a handshake whose signature was verified.
+        :return: True if the number was still pending and not expired, so a number is accepted only once.
+        """
+        key = (str(process_instance_id), reader_address)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != number_to_sign:
+                return False
+            del self.entries[key]
+            self.record('delete', key)
+        self.throttle()
+        return entry[1] >= time.time()
+
+
+    def record(self, operation, key, value=None):
+        # Queue a change for the database, called with the lock held. Only the last change of a reader is kept
+        if self.database is None:
+            return
+        self.pending.pop(key, None)
+        self.pending[key] = (operation, value)
+        if self.writer is None:
+            self.writer = threading.Thread(target=self.write_behind, args=(self.flush_interval,), daemon=True)
+            self.writer.start()
+
+
+    def throttle(self):
+        # Past max_pending queued changes, the database is too slow or failing: the caller writes them itself
+        if len(self.pending) > self.max_pending:
+            self.flush()
+
+
+    def flush(self, connection=None):
+        """
+        Write the queued changes to the database. On a sqlite error they are queued again, unless
+        more than max_pending changes would be queued: then they are dropped and the table stays behind.
+        :param connection: The connection of the writer thread, a new one by default.
+        """
+        with self.write_lock:
+            with self.lock:
+                pending, self.pending = self.pending, OrderedDict()
+            if not pending:
+                return
+            try:
+                if connection is None:
+                    with contextlib.closing(sqlite3.connect(self.database)) as connection:
+                        self.write(connection, pending)
+                else:
+                    self.write(connection, pending)
+            except sqlite3.Error as e:
+                with self.lock:
+                    if len(self.pending) + len(pending) > self.max_pending:
+                        print(f"[NONCE STORE] {len(pending)} changes dropped, the database is not updated: {e}")
+                        return
+                    print(f"[NONCE STORE] {len(pending)} changes not written, retrying: {e}")
+                    # The changes queued meanwhile are newer
+                    for key, change in pending.items():
+                        self.pending.setdefault(key, change)
+
+
+    def write(self, connection, pending):
+        with connection:
+            for key, (operation, value) in pending.items():
+                if operation == 'insert':
+                    connection.execute("INSERT OR REPLACE INTO handshake_numbers (process_instance, reader_address, "
+                                       "handshake_number, expires) VALUES (?,?,?,?)", key + value)
+                else:
+                    connection.execute("DELETE FROM handshake_numbers WHERE process_instance=? AND reader_address=?", key)
+
+
+    def write_behind(self, flush_interval):
+        connection = sqlite3.connect(self.database)
+        while True:
+            time.sleep(flush_interval)
+            self.flush(connection)
@@ -0,0 +1,129 @@
+from collections import OrderedDict
+from policy_util import ThresholdPolicyParser
+
+
+class CompiledPolicy:
+    """
+    Parsed form of a policy: the policy string, its tree, its attribute list and the
+    satisfying sets (with their Lagrange coefficients) already computed for it
+    """
+
+
+    def __init__(self, policy, tree, attributes):
+        self.policy = policy
+        self.tree = tree
+        self.attributes = attributes
+        self.selections = OrderedDict()
+
+
+class PolicyCompiler:
+    """
+    Normalizes and minimizes policy formulas, and keeps the compiled policies in a bounded LRU
+    keyed by the normalized policy string
+    """
+
+
+    def __init__(self, util, size=256, selections_size=16):
+        self.util = util
+        self.size = size
+        self.selections_size = selections_size
+        self.entries = OrderedDict()
+        self.aliases = OrderedDict()
+
+
+    def normalize(self, policy_string):
+        """
+        Rewrite a policy in canonical form. AND/OR chains are flattened, duplicate operands removed,
+        absorbed clauses dropped, e.g. A or (A and B) -> A, and the operands of every gate sorted.
+        :param policy_string: The access policy.
+        :return: The normalized access policy, equivalent to the input one.
+        """
+        return self._render(self._simplify(ThresholdPolicyParser().parse(policy_string)))
+
+
+    def compile(self, policy_string, normalize=True):
+        """
+        Return the compiled policy, parsing it only if it is not in the cache.
+        :param policy_string: The access policy.
+        :param normalize: If True compile the normalized policy. Decryption must use False, since
+         the shares of a ciphertext are bound to the tree of the policy string stored in it.
+        :return: The CompiledPolicy.
+        """
+        key = self.aliases.get(policy_string) if normalize else policy_string
+        if key is None:
+            key = self.normalize(policy_string)
+            self.aliases[policy_string] = key
+            if len(self.aliases) > self.size:
+                self.aliases.popitem(last=False)
+        elif normalize:
+            self.aliases.move_to_end(policy_string)
+        compiled = self.entries.get(key)
+        if compiled is None:
+            tree = self.util.createPolicy(key)
+            compiled = CompiledPolicy(key, tree, self.util.getAttributeList(tree))
+            self.entries[key] = compiled
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        else:
+            self.entries.move_to_end(key)
+        return compiled
+
+
+    def satisfying_set(self, compiled, attributes, cheapest=True):
+        """
+        Return the satisfying set of the compiled policy for the attributes, see PolicyUtil.satisfying_set.
+        The selection and its coefficients are cached in the compiled policy.
+        """
+        key = (frozenset(attributes), cheapest)
+        if key in compiled.selections:
+            compiled.selections.move_to_end(key)
+            return compiled.selections[key]
+        selection = self.util.satisfying_set(compiled.tree, key[0], cheapest)
+        compiled.selections[key] = selection
+        if len(compiled.selections) > self.selections_size:
+            compiled.selections.popitem(last=False)
+        return selection
+
+
+    def _kind(self, node):
+        if isinstance(node, str):
+            return 'attr'
+        threshold, children = node
+        if threshold == 1:
+            return 'or'
+        return 'and' if threshold == len(children) else 'threshold'
+
+
+    def _render(self, node):
+        kind = self._kind(node)
+        if kind == 'attr':
+            return node
+        children = [self._render(child) for child in node[1]]
+        if kind == 'threshold':
+            return '(%d of (%s))' % (node[0], ', '.join(children))
+        return '(' + (' %s ' % kind).join(children) + ')'
+
+
+    def _simplify(self, node):
+        # Returns an attribute name, or a (threshold, children) gate with simplified children
+        gate = self.util.gate(node)
+        if gate is None:
+            return node.getAttribute()
+        threshold, children = gate
+        children = [self._simplify(child) for child in children]
+        if 1 < threshold < len(children):
+            return threshold, sorted(children, key=self._render)
+        kind = 'or' if threshold == 1 else 'and'
+        operands = {}
+        for child in children:
+            for operand in (child[1] if self._kind(child) == kind else [child]):
+                operands.setdefault(self._render(operand), operand)
+        # Absorption: in an OR drop every clause implying another one, in an AND every clause implied by another one
+        dual = 'and' if kind == 'or' else 'or'
+        terms = {key: set(self._render(term) for term in operand[1]) if self._kind(operand) == dual else {key}
+                 for key, operand in operands.items()}
+        kept = [key for key in operands if not any(other != key and terms[other] < terms[key] for other in operands)]
+        if len(kept) == 1:
+            return operands[kept[0]]
+        kept.sort()
+        return (1 if kind == 'or' else len(kept)), [operands[key] for key in kept]
@@ -1,6 +1,8 @@
 from itertools import combinations  # Importing combinations to generate subsets of a given size
 
-def policy_plus(policy, num_Auth):
+def policy_plus(policy, num_Auth, threshold=True):
+    # With threshold=True a k-of-n requirement becomes a native "k of (...)" gate, shared with a
+    # polynomial of degree k-1, instead of the OR of every k-combination of the Authorities
     # Extract unique attributes with "+" and ensure they are stripped of parentheses
     policy_Split = [f.strip("()") for seen in [set()]  # `seen` ensures no duplicate processing
                      for f in policy.split(" ")        # Split the policy into individual elements
@@ -28,7 +30,11 @@ def policy_plus(policy, num_Auth):
         elif int(value) == num_Auth:
             transformation = f"({' and '.join(authorities)})"
 
-        # Handle the case where a subset of Authorities is required
+        # Handle the case where a subset of Authorities is required with a single threshold gate
+        elif threshold:
+            transformation = f"({value} of ({', '.join(authorities)}))"
+
+        # Handle the case where a subset of Authorities is required with the DNF expansion
         else:
             authority_combinations = combinations(authorities, int(value))  # Generate combinations of the required size
             transformation = "(" + ' or '.join([f"({' and '.join(comb)})" for comb in authority_combinations]) + ")"
@@ -0,0 +1,215 @@
+from charm.toolbox.secretutil import SecretUtil
+from charm.toolbox.node import BinNode, OpType
+import re
+
+
+class ThresholdNode:
+    """
+    Gate of a policy tree satisfied by at least threshold of its children
+    """
+
+
+    def __init__(self, threshold, children):
+        self.threshold = threshold
+        self.children = children
+
+
+    def getNodeType(self):
+        return OpType.THRESHOLD
+
+
+    def __str__(self):
+        children = [str(child) for child in self.children]
+        if self.threshold == len(children):
+            return '(' + ' and '.join(children) + ')'
+        if self.threshold == 1:
+            return '(' + ' or '.join(children) + ')'
+        return '(%d of (%s))' % (self.threshold, ', '.join(children))
+
+
+class ThresholdPolicyParser:
+    """
+    Parser of policies with k-of-n threshold gates, written as 'k of (A, B, C)'.
+    As in the charm parser, AND and OR have the same precedence and a chain is grouped from left
+    to right: A or B and C is (A or B) and C. Consecutive operands of one operator become a single n-ary gate.
+    """
+
+
+    def parse(self, string):
+        self.tokens = re.findall(r'[(),]|[^\s(),]+', string)
+        self.position = 0
+        tree = self.expression()
+        if self.position != len(self.tokens):
+            raise Exception("Unexpected token '%s' in policy" % self.tokens[self.position])
+        return tree
+
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+
+    def take(self, expected=None):
+        token = self.peek()
+        if token is None or (expected is not None and token.lower() != expected):
+            raise Exception("Expected '%s' in policy, found '%s'" % (expected, token))
+        self.position += 1
+        return token
+
+
+    def gate(self, threshold, children):
+        return children[0] if len(children) == 1 else ThresholdNode(threshold, children)
+
+
+    def expression(self):
+        operator, children = None, [self.term()]
+        while (self.peek() or '').lower() in ('and', 'or'):
+            following = self.take().lower()
+            if operator is not None and following != operator:
+                children = [self.chain(operator, children)]
+            operator = following
+            children.append(self.term())
+        return self.chain(operator, children)
+
+
+    def chain(self, operator, children):
+        return self.gate(1 if operator == 'or' else len(children), children)
+
+
+    def term(self):
+        token = self.take()
+        if token == '(':
+            tree = self.expression()
+            self.take(')')
+            return tree
+        if token.isdigit() and (self.peek() or '').lower() == 'of':
+            self.take()
+            self.take('(')
+            children = [self.expression()]
+            while self.peek() == ',':
+                self.take()
+                children.append(self.expression())
+            self.take(')')
+            threshold = int(token)
+            if threshold < 1 or threshold > len(children):
+                raise Exception("Invalid threshold gate: %d of %d" % (threshold, len(children)))
+            return self.gate(threshold, children)
+        if token in ('(', ')', ',') or token.lower() in ('and', 'or', 'of'):
+            raise Exception("Unexpected token '%s' in policy" % token)
+        return BinNode(token)
+
+
+class PolicyUtil(SecretUtil):
+    """
+    Secret sharing utilities over access policy trees, extending the charm SecretUtil
+    with k-of-n threshold gates and the selection of the attributes used for decryption
+    """
+
+
+    threshold_syntax = re.compile(r'\b\d+\s+of\s*\(', re.IGNORECASE)
+
+
+    def createPolicy(self, policy_string):
+        """
+        Parse a policy string into a policy tree. Policies with threshold gates are parsed
+        by ThresholdPolicyParser, the others by the charm parser as before. Both group AND/OR
+        chains from left to right, so a policy means the same with or without a threshold gate.
+        :param policy_string: The access policy.
+        :return: The policy tree, with duplicate attributes labelled by an index.
+        """
+        if not self.threshold_syntax.search(policy_string):
+            return SecretUtil.createPolicy(self, policy_string)
+        policy = ThresholdPolicyParser().parse(policy_string)
+        leaves = self.leaves(policy)
+        counts = {}
+        for leaf in leaves:
+            counts[leaf.getAttribute()] = counts.get(leaf.getAttribute(), 0) + 1
+        labels = {}
+        for leaf in leaves:
+            if counts[leaf.getAttribute()] > 1:
+                leaf.index = labels.get(leaf.getAttribute(), 0)
+                labels[leaf.getAttribute()] = leaf.index + 1
+        return policy
+
+
+    def gate(self, node):
+        """
+        Describes a node of the policy tree as a threshold gate
+        :param node: The policy tree node.
+        :return: The threshold and the list of children of the gate, None if the node is an attribute.
+        """
+        if isinstance(node, ThresholdNode):
+            return node.threshold, node.children
+        if node.getNodeType() == OpType.AND:
+            return 2, [node.getLeft(), node.getRight()]
+        if node.getNodeType() == OpType.OR:
+            return 1, [node.getLeft(), node.getRight()]
+        return None
+
+
+    def leaves(self, policy):
+        """
+        Return the attribute leaves of the policy tree from left to right
+        """
+        gate = self.gate(policy)
+        if gate is None:
+            return [policy]
+        return [leaf for child in gate[1] for leaf in self.leaves(child)]
+
+
+    def getAttributeList(self, Node):
+        return [leaf.getAttributeAndIndex() for leaf in self.leaves(Node)]
+
+
+    def calculateSharesDict(self, secret, tree):
+        """
+        Share the secret over the policy tree, with a polynomial of degree k-1 at every k-of-n gate.
+        :return: A dictionary from attribute (with index) to share.
+        """
+        shares = {}
+        self._share(secret, tree, shares)
+        return shares
+
+
+    def _share(self, secret, node, shares):
+        gate = self.gate(node)
+        if gate is None:
+            shares.setdefault(node.getAttributeAndIndex(), secret)
+            return
+        threshold, children = gate
+        values = self.genShares(secret, threshold, len(children))
+        for index, child in enumerate(children, 1):
+            self._share(values[index], child, shares)
+
+
+    def satisfying_set(self, policy, attributes, cheapest=True):
+        """
+        Select the policy leaves used for decryption, together with their reconstruction coefficients.
+        :param policy: The policy tree.
+        :param attributes: The attributes of the user.
+        :param cheapest: If True select the satisfying set with the fewest leaves, and therefore the fewest
+         pairings, otherwise the first one found from left to right, as SecretUtil.prune does.
+        :return: A list of (leaf, coefficient) pairs, or None if the attributes do not satisfy the policy.
+        """
+        return self._select(policy, set(attributes), cheapest)
+
+
+    def _select(self, node, attributes, cheapest):
+        gate = self.gate(node)
+        if gate is None:
+            return [(node, 1)] if node.getAttribute() in attributes else None
+        threshold, children = gate
+        options = []
+        for index, child in enumerate(children, 1):
+            selection = self._select(child, attributes, cheapest)
+            if selection is not None:
+                options.append((index, selection))
+                if not cheapest and len(options) == threshold:
+                    break
+        if len(options) < threshold:
+            return None
+        if cheapest:
+            # Subtrees are independent, so the k cheapest satisfiable children give the cheapest gate
+            options = sorted(options, key=lambda option: len(option[1]))[:threshold]
+        coefficients = self.recoverCoefficients([index for index, _ in options])
+        return [(leaf, coefficient * coefficients[index])
+                for index, selection in options for leaf, coefficient in selection]
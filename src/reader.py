@@ -1,16 +1,21 @@
 from charm.toolbox.pairinggroup import *
-from charm.core.engine.util import bytesToObject
+from charm.core.engine.util import objectToBytes, bytesToObject
 import cryptocode
 import block_int
 import ipfshttpclient
 import json
 import os
+import contextlib
 import base64
 from maabe_class import *
+from hash_cache import hash_cache
+from reader_key_ring import ReaderKeyRing
 from decouple import config
 import sqlite3
 import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from authorities_info import authorities_addresses_and_names_separated
+from symmetric_crypto import derive_key, decrypt_stream, read_slice_key
 
 
 def merge_dicts(*dict_args):
@@ -61,6 +66,44 @@ def base64_to_file(encoded_data, output_file_path):
         print(f"Error decoding Base64 to file: {e}")
 
 
+class IPFSStream:
+    """
+    Read-only file-like object over a streamed IPFS cat, holding only the data not yet read
+    """
+
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.iterator = iter(chunks)
+        self.buffer = bytearray()
+
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            chunk = next(self.iterator, None)
+            if chunk is None:
+                break
+            self.buffer += chunk
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+
+    def close(self):
+        if hasattr(self.chunks, 'close'):
+            self.chunks.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
 def retrieve_public_parameters(process_instance_id):
     """
     Retrieve public parameters for the process instance
@@ -90,31 +133,87 @@ def actual_decryption(remaining, public_parameters, user_sk, output_folder):
     base64_to_file(decryptedFile, output_folder_path+"/"+remaining['FileName'])
 
 
-def start(process_instance_id, message_id, slice_id, sender_address, output_folder, merged, function):
+def slice_decryption(entry, public_parameters, user_sk, output_folder, key_cache=None):
+    """
+    Decrypt a slice object listed in a manifest: the ciphered key is at the start of the object,
+    or in the object linked by KeyLink when the key encapsulation is shared by the slices of a policy.
+    A shared key is recovered once per key_cache, a dictionary from KeyLink to the recovered key.
+    The object is streamed from IPFS and decrypted chunk by chunk into the output file.
+    """
+    with IPFSStream(api.cat(entry['Link'], stream=True)) as source:
+        ciphered_key = read_slice_key(source)
+        if ciphered_key:
+            file_key = recover_key(ciphered_key, public_parameters, user_sk)
+        else:
+            shared_key = key_cache.get(entry['KeyLink']) if key_cache is not None else None
+            if shared_key is None:
+                shared_key = recover_key(api.cat(entry['KeyLink']), public_parameters, user_sk)
+                if key_cache is not None:
+                    key_cache[entry['KeyLink']] = shared_key
+            file_key = derive_key(shared_key, entry.get('Slice_id', entry['FileName']))
+        output_file_path = os.path.abspath(output_folder) + "/" + entry['FileName']
+        write_decrypted(file_key, source, output_file_path)
+
+
+def recover_key(ciphered_key, public_parameters, user_sk):
+    # Decrypt the ABE encapsulation of a key, the pairings of a slice
+    ct = bytesToObject(ciphered_key, groupObj)
+    return groupObj.serialize(maabe.decrypt(public_parameters, user_sk, ct))
+
+
+def write_decrypted(file_key, source, output_file_path):
+    # A partial output file is removed, keeping the error of the decryption when the file could not even be opened
+    try:
+        with open(output_file_path, 'wb') as output_file:
+            decrypt_stream(file_key, source, output_file)
+    except Exception:
+        with contextlib.suppress(OSError):
+            os.remove(output_file_path)
+        raise
+
+
+def accessible_slices(slices, attributes):
+    """
+    Return the slices of a manifest whose policy is satisfied by the attributes.
+    Only the policies are evaluated, no pairing is computed and no slice is downloaded.
+    """
+    attributes = set(attributes)
+    accessible = []
+    for entry in slices:
+        if attributes.isdisjoint(entry['Attributes']):
+            continue
+        policy = maabe.compiler.compile(entry['Policy'], normalize=False)
+        if maabe.compiler.satisfying_set(policy, attributes) is not None:
+            accessible.append(entry)
+    return accessible
+
+
+def load_public_parameters(process_instance_id):
     """
-    Main decryption workflow based on the provided message and slice IDs
+    Deserialize the public parameters of the process instance
     """
     response = retrieve_public_parameters(process_instance_id)
     public_parameters = bytesToObject(response, groupObj)
-    H = lambda x: self.group.hash(x, G2)
-    F = lambda x: self.group.hash(x, G2)
-    public_parameters["H"] = H
-    public_parameters["F"] = F
-    for authority_name in authorities_names:
-        f = authority_name[0].upper() + authority_name[1:].lower()
-        prefix = ''.join(filter(str.isalpha, f))
-        number = ''.join(filter(str.isdigit, f))
-        transformed_string = f"{prefix}-{number}"
-        x.execute("SELECT * FROM authorities_generated_decription_keys WHERE process_instance=? AND authority_name=? AND reader_address=?",
-                  (str(process_instance_id), transformed_string, sender_address))
-        result = x.fetchall()
-        user_sk1 = result[0][3]
-        user_sk1 = user_sk1.encode()
-        user_sk1 = bytesToObject(user_sk1, groupObj)
-        merged = merge_dicts(merged, user_sk1)
-    user_sk = {'GID': sender_address, 'keys': merged}
-    # decrypt
+    public_parameters["H"] = hash_cache(groupObj).hash
+    public_parameters["F"] = hash_cache(groupObj).hash
+    return public_parameters
+
+
+def user_secret_key(process_instance_id, sender_address, merged):
+    """
+    Merge the keys generated by every Authority for the reader into the user secret key,
+    taken from the reader key ring
+    """
+    user_sk = key_ring.user_secret_key(process_instance_id, sender_address)
+    if not merged:
+        return user_sk
+    return {'GID': sender_address, 'keys': merge_dicts(merged, user_sk['keys'])}
 
+
+def retrieve_message(process_instance_id, message_id, function):
+    """
+    Retrieve the message from the chain and IPFS, None if its metadata does not match the chain
+    """
     response = []
 
     if function == "getApplicationForm":
@@ -142,6 +241,36 @@ def start(process_instance_id, message_id, slice_id, sender_address, output_fold
     if ciphertext_dict['metadata']['process_instance_id'] == int(process_instance_id) \
             and ciphertext_dict['metadata']['message_id'] == int(message_id) \
             and ciphertext_dict['metadata']['sender'] == sender:
+        return ciphertext_dict
+    return None
+
+
+def start(process_instance_id, message_id, slice_id, sender_address, output_folder, merged, function, list_slices=False, all_slices=False):
+    """
+    Main decryption workflow based on the provided message and slice IDs.
+    With list_slices only print the slices of the message the reader can decrypt,
+    with all_slices decrypt all of them.
+    """
+    public_parameters = load_public_parameters(process_instance_id)
+    user_sk = user_secret_key(process_instance_id, sender_address, merged)
+    # decrypt
+    ciphertext_dict = retrieve_message(process_instance_id, message_id, function)
+    if ciphertext_dict is not None:
+        if 'slices' in ciphertext_dict:
+            # Manifest: download only the slice to decrypt
+            slices = ciphertext_dict['slices']
+            if list_slices or all_slices:
+                slices = accessible_slices(slices, user_sk['keys'].keys())
+                for entry in slices:
+                    print(f"slice id {entry['FileName']}: {entry.get('Slice_id')}")
+                if list_slices:
+                    return
+            key_cache = {}
+            for entry in slices:
+                if all_slices or len(slices) == 1 or entry['Slice_id'] == slice_id:
+                    slice_decryption(entry, public_parameters, user_sk, output_folder, key_cache)
+            print(hash_cache(groupObj))
+            return
         slice_check = ciphertext_dict['header']
         if len(slice_check) == 1:
             actual_decryption(ciphertext_dict['header'][0], public_parameters, user_sk, output_folder)
@@ -149,6 +278,85 @@ def start(process_instance_id, message_id, slice_id, sender_address, output_fold
             for remaining in slice_check:
                 if remaining['Slice_id'] == slice_id:
                     actual_decryption(remaining, public_parameters, user_sk, output_folder)
+        print(hash_cache(groupObj))
+
+
+# Public parameters and user secret key of the decryption tasks, in the worker processes or in the current process
+worker_context = {}
+
+
+def init_reader_worker(public_parameters_bytes, user_sk_bytes):
+    """
+    Build the group, the MA-ABE scheme, the IPFS client and the user secret key of a decryption worker process
+    """
+    global groupObj, maabe, api
+    groupObj = PairingGroup('SS512')
+    maabe = MaabeRW15(groupObj)
+    api = ipfshttpclient.connect('/ip4/127.0.0.1/tcp/5001')
+    public_parameters = bytesToObject(public_parameters_bytes, groupObj)
+    public_parameters["H"] = hash_cache(groupObj).hash
+    public_parameters["F"] = hash_cache(groupObj).hash
+    worker_context.update(public_parameters=public_parameters, user_sk=bytesToObject(user_sk_bytes, groupObj), key_cache={})
+
+
+def decryption_task(task):
+    """
+    Decrypt a slice of a manifest, or an entry of a message header, and return None or the error
+    """
+    entry, output_folder = task
+    try:
+        if 'Link' in entry:
+            slice_decryption(entry, worker_context['public_parameters'], worker_context['user_sk'], output_folder,
+                             worker_context['key_cache'])
+        else:
+            actual_decryption(entry, worker_context['public_parameters'], worker_context['user_sk'], output_folder)
+    except Exception as e:
+        return str(e)
+    return None
+
+
+def batch(process_instance_id, targets, sender_address, output_folder, workers=1):
+    """
+    Decrypt many messages and slices with a single user secret key, on a pool of worker processes.
+    :param targets: A list of dictionaries with function, message_id and optionally slice_id.
+     Without slice_id every slice of the message the reader can decrypt is selected.
+    :param output_folder: The folder receiving one subfolder per message.
+    :param workers: The number of worker processes, 1 to decrypt in the current process.
+    """
+    public_parameters = load_public_parameters(process_instance_id)
+    user_sk = user_secret_key(process_instance_id, sender_address, {})
+    tasks = []
+    for target in targets:
+        ciphertext_dict = retrieve_message(process_instance_id, target['message_id'], target['function'])
+        if ciphertext_dict is None:
+            print(f"message {target['message_id']}: metadata does not match the chain")
+            continue
+        message_folder = os.path.join(os.path.abspath(output_folder), str(target['message_id']))
+        os.makedirs(message_folder, exist_ok=True)
+        slice_id = target.get('slice_id')
+        if 'slices' in ciphertext_dict:
+            entries = ciphertext_dict['slices']
+            if slice_id is None and len(entries) > 1:
+                entries = accessible_slices(entries, user_sk['keys'].keys())
+        else:
+            entries = ciphertext_dict['header']
+        for entry in entries:
+            if slice_id is None or entry.get('Slice_id') == slice_id:
+                tasks.append((entry, message_folder))
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=init_reader_worker,
+                                       initargs=(retrieve_public_parameters(process_instance_id), objectToBytes(user_sk, groupObj)))
+    else:
+        worker_context.update(public_parameters=public_parameters, user_sk=user_sk, key_cache={})
+        executor = ThreadPoolExecutor(max_workers=1)
+    failed = 0
+    with executor:
+        for (entry, message_folder), error in zip(tasks, executor.map(decryption_task, tasks)):
+            if error is not None:
+                failed += 1
+                print(f"{message_folder}/{entry['FileName']}: {error}")
+    print(f"{len(tasks) - failed} of {len(tasks)} slices decrypted")
+
 
 if __name__ == '__main__':
     authorities_addresses, authorities_names = authorities_addresses_and_names_separated()
@@ -158,6 +366,7 @@ if __name__ == '__main__':
     x = conn.cursor()
     groupObj = PairingGroup('SS512')
     maabe = MaabeRW15(groupObj)
+    key_ring = ReaderKeyRing(groupObj, conn, authorities_names)
     api = ipfshttpclient.connect('/ip4/127.0.0.1/tcp/5001')
     process_instance_id = int(process_instance_id_env)
     parser = argparse.ArgumentParser(description="Reader details",
@@ -167,11 +376,20 @@ if __name__ == '__main__':
     parser.add_argument("--reader_name", type=str, help="Name of the requester")
     parser.add_argument("-o", "--output_folder", type=str, help="Path to the output folder")
     parser.add_argument('-f', '--function', type=str, help='Smart Contract function to call.')
+    parser.add_argument('-l', '--list', action='store_true', help='List the slices the reader can decrypt')
+    parser.add_argument('-a', '--all', action='store_true', help='Decrypt all the slices the reader can decrypt')
+    parser.add_argument('-b', '--batch', type=str, help='Path to a JSON list of targets (function, message_id, optional slice_id) to decrypt')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='Number of worker processes of the batch mode')
     args = parser.parse_args()
     message_id = args.message_id
     slice_id = args.slice_id
     sender_address = config(args.reader_name + '_ADDRESS')
     output_folder = args.output_folder
     merged = {}
-    start(process_instance_id, message_id, slice_id, sender_address, output_folder, merged, args.function)
+    if args.batch:
+        with open(args.batch, 'r') as targets_file:
+            targets = json.load(targets_file)
+        batch(process_instance_id, targets, sender_address, output_folder, args.workers)
+    else:
+        start(process_instance_id, message_id, slice_id, sender_address, output_folder, merged, args.function, args.list, args.all)
 
@@ -0,0 +1,122 @@
+import struct
+from hashlib import sha256
+from charm.core.engine.util import bytesToObject
+
+MAGIC = b'CGSK'
+
+
+class ReaderKeyRing:
+    """
+    User secret keys of the readers, merged from the keys generated by every Authority.
+    A key ring is assembled once per (process instance, reader), kept in memory and persisted in the
+    reader database in a compact binary form, together with a fingerprint of the generated keys it was
+    built from: a change in the authorities_generated_decription_keys table invalidates it.
+    """
+
+
+    def __init__(self, groupObj, conn, authorities_names):
+        self.groupObj = groupObj
+        self.conn = conn
+        self.authorities_names = authorities_names
+        self.entries = {}
+        self.conn.execute("CREATE TABLE IF NOT EXISTS reader_key_rings (process_instance TEXT, reader_address TEXT, "
+                          "fingerprint TEXT, key_ring BLOB, primary key (process_instance, reader_address))")
+
+
+    def fingerprint(self, process_instance_id, reader_address):
+        """
+        Fingerprint of the generated keys of the reader, computed without reading the keys
+        """
+        x = self.conn.cursor()
+        x.execute("SELECT authority_name, rowid, length(decription_key), substr(decription_key, -32) "
+                  "FROM authorities_generated_decription_keys WHERE process_instance=? AND reader_address=? "
+                  "ORDER BY authority_name", (str(process_instance_id), reader_address))
+        return sha256(repr(x.fetchall()).encode('utf-8')).hexdigest()
+
+
+    def assemble(self, process_instance_id, reader_address):
+        # Merge the keys of every Authority, as stored by the client
+        x = self.conn.cursor()
+        keys = {}
+        for authority_name in self.authorities_names:
+            f = authority_name[0].upper() + authority_name[1:].lower()
+            prefix = ''.join(filter(str.isalpha, f))
+            number = ''.join(filter(str.isdigit, f))
+            transformed_string = f"{prefix}-{number}"
+            x.execute("SELECT * FROM authorities_generated_decription_keys WHERE process_instance=? AND authority_name=? AND reader_address=?",
+                      (str(process_instance_id), transformed_string, reader_address))
+            result = x.fetchall()
+            if not result:
+                raise Exception(f"No key generated by {authority_name} for reader {reader_address}")
+            keys.update(bytesToObject(result[0][3].encode(), self.groupObj))
+        return {'GID': reader_address, 'keys': keys}
+
+
+    def encode(self, user_sk):
+        """
+        Serialize a user secret key: GID, then every attribute with the serialized group elements of its key
+        """
+        def field(value):
+            return struct.pack('>H', len(value)) + value
+        data = [MAGIC, field(user_sk['GID'].encode('utf-8')), struct.pack('>H', len(user_sk['keys']))]
+        for attribute, key in user_sk['keys'].items():
+            data.append(field(attribute.encode('utf-8')) + struct.pack('>B', len(key)))
+            for name in sorted(key):
+                data.append(field(name.encode('utf-8')) + field(self.groupObj.serialize(key[name])))
+        return b''.join(data)
+
+
+    def decode(self, data):
+        """
+        Deserialize a user secret key written by encode
+        """
+        if data[:len(MAGIC)] != MAGIC:
+            raise Exception("Not a reader key ring")
+        position = len(MAGIC)
+
+        def field():
+            nonlocal position
+            (length,) = struct.unpack_from('>H', data, position)
+            position += 2 + length
+            return data[position - length:position]
+        gid = field().decode('utf-8')
+        (count,) = struct.unpack_from('>H', data, position)
+        position += 2
+        keys = {}
+        for _ in range(count):
+            attribute = field().decode('utf-8')
+            (elements,) = struct.unpack_from('>B', data, position)
+            position += 1
+            key = {}
+            for _ in range(elements):
+                name = field().decode('utf-8')
+                key[name] = self.groupObj.deserialize(field())
+            keys[attribute] = key
+        return {'GID': gid, 'keys': keys}
+
+
+    def user_secret_key(self, process_instance_id, reader_address):
+        """
+        Return the merged user secret key of the reader, from memory, from the persisted key ring
+        or, if the generated keys changed, by assembling it again.
+        :param process_instance_id: The process instance.
+        :param reader_address: The address of the reader, its GID.
+        :return: The user secret key {'GID', 'keys'}.
+        """
+        fingerprint = self.fingerprint(process_instance_id, reader_address)
+        entry = self.entries.get((str(process_instance_id), reader_address))
+        if entry is not None and entry[0] == fingerprint:
+            return entry[1]
+        x = self.conn.cursor()
+        x.execute("SELECT fingerprint, key_ring FROM reader_key_rings WHERE process_instance=? AND reader_address=?",
+                  (str(process_instance_id), reader_address))
+        result = x.fetchall()
+        if result and result[0][0] == fingerprint:
+            user_sk = self.decode(bytes(result[0][1]))
+        else:
+            user_sk = self.assemble(process_instance_id, reader_address)
+            x.execute("INSERT OR REPLACE INTO reader_key_rings VALUES (?,?,?,?)",
+                      (str(process_instance_id), reader_address, fingerprint, self.encode(user_sk)))
+            self.conn.commit()
+        self.entries[(str(process_instance_id), reader_address)] = (fingerprint, user_sk)
+        return user_sk
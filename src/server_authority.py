@@ -1,92 +1,377 @@
+import os
 import socket
+import asyncio
 import ssl
+import time
 import threading
-import random
-from datetime import datetime
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait
+from concurrent.futures.process import BrokenProcessPool
+import secrets
 from hashlib import sha512
 import block_int
 import authority_key_generation
+import wire_protocol
+from nonce_store import NonceStore
 import ipfshttpclient
-import sqlite3
 from decouple import config
 import argparse
 from authorities_info import authorities_names
 
+"""
+Cache of the readers' RSA public keys, indexed by reader address
+Every entry remembers the on-chain IPFS link it was read from: after ttl seconds the link is checked again
+on chain, and the key file is downloaded from IPFS again only if the link changed. The chain does not notify
+a new key, so a rotated or revoked key is still accepted for up to ttl seconds; with ttl 0 the link is
+checked at every handshake
+"""
+class ReaderPublicKeyCache:
+    def __init__(self, ttl=10):
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    # Downloads and parses the public key file of a reader
+    def fetch(self, reader_address, public_key_ipfs_link):
+        api = ipfshttpclient.connect('/ip4/127.0.0.1/tcp/5001')
+        getfile = api.cat(public_key_ipfs_link).split(b'###')
+        if getfile[0].split(b': ')[1].decode('utf-8') != reader_address:
+            raise Exception(f"The public key file of {reader_address} belongs to another reader")
+        public_key_n = int(getfile[1].decode('utf-8'))
+        public_key_e = int(getfile[2].decode('utf-8').rstrip('"'))
+        return public_key_n, public_key_e
+
+    # Returns the public key (n, e) of the reader and whether it was checked on chain by this call
+    def public_key(self, reader_address, refresh=False):
+        with self.lock:
+            entry = self.entries.get(reader_address)
+        if entry is not None and not refresh and time.monotonic() - entry['checked'] < self.ttl:
+            return entry['key'], False
+        public_key_ipfs_link = block_int.retrieve_publicKey_readers(reader_address)
+        if entry is not None and entry['link'] == public_key_ipfs_link:
+            key = entry['key']
+        else:
+            key = self.fetch(reader_address, public_key_ipfs_link)
+        with self.lock:
+            self.entries[reader_address] = {'link': public_key_ipfs_link, 'key': key, 'checked': time.monotonic()}
+        return key, True
+
+    # Loads the keys of many readers concurrently, returning how many were loaded
+    def warm(self, reader_addresses, workers=8):
+        def load(reader_address):
+            try:
+                self.public_key(reader_address)
+                return True
+            except Exception:
+                return False
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return sum(executor.map(load, list(reader_addresses)))
+
 """
 Class representing the Authority
 Handles key generation, message signing, and secure client-server communication
 """
 class AuthorityServer:
-    def __init__(self, authority_number):
+    def __init__(self, authority_number, persist_nonces=False, public_key_ttl=10):
         self.authority_number = authority_number
+        self.keygen_executor = None
+        self.keygen_workers = 0
+        self.keygen_lock = threading.Lock()
+        self.public_keys = ReaderPublicKeyCache(public_key_ttl)
+        database = '../databases/authority'+str(authority_number)+'/authority'+str(authority_number)+'.db'
+        self.nonces = NonceStore(database=database if persist_nonces else None)
+
+    # Generates the Authority key for a specific reader, serialized or in the raw encoding of the binary protocol
+    def generate_key_auth(self, gid, process_instance_id, reader_address, raw=False):
+        return authority_key_generation.generate_user_key(self.authority_number, gid, process_instance_id, reader_address, raw)
+
+    # Forks the pool of processes generating the keys of the batch requests. It must be called after preload
+    # and before the server starts any thread: the workers inherit the preloaded contexts (g2^alpha, the
+    # attribute hashes and the attribute table) and no lock is held by another thread at the fork.
+    # A process instance that was not preloaded is loaded from the chain and IPFS by every worker using it
+    def start_keygen_pool(self, workers):
+        if workers < 1:
+            return
+        self.keygen_workers = workers
+        self.keygen_executor = self.keygen_pool('fork')
+        # Workers are started on demand, fork all of them now
+        wait([self.keygen_executor.submit(int) for _ in range(workers)])
+
+    def keygen_pool(self, start_method):
+        return ProcessPoolExecutor(max_workers=self.keygen_workers, mp_context=multiprocessing.get_context(start_method),
+                                   initializer=authority_key_generation.init_keygen_worker,
+                                   initargs=(authority_key_generation.AuthorityContext.attributes_ttl,))
 
-    # Generates the Authority key for a specific reader
-    def generate_key_auth(self, gid, process_instance_id, reader_address):
-        return authority_key_generation.generate_user_key(self.authority_number, gid, process_instance_id, reader_address)
+    # Replaces the pool after a worker died. The server threads are running, so the new workers are started
+    # by a fork server and load the contexts of the process instances on first use
+    def restart_keygen_pool(self, broken):
+        with self.keygen_lock:
+            if self.keygen_executor is broken:
+                print("[KEYGEN POOL] A key generation worker died, restarting the pool")
+                broken.shutdown(wait=False)
+                self.keygen_executor = self.keygen_pool('forkserver')
+
+    # Verifies the signatures of a batch of readers, then generates their keys in chunks on the key generation
+    # pool. Yields a BATCH_KEY frame per reader as its chunk completes, an ERROR frame per rejected reader,
+    # and BATCH_END with the number of keys issued
+    def generate_keys_batch(self, process_instance_id, numbers_to_sign, signatures):
+        # The public keys missing from the cache are fetched concurrently, not one handshake at a time
+        self.public_keys.warm(reader_address for reader_address, _ in signatures)
+        readers = []
+        for reader_address, signature in signatures:
+            number_to_sign = numbers_to_sign.pop(reader_address, None)
+            if number_to_sign is not None and self.check_handshake(process_instance_id, reader_address, signature, number_to_sign):
+                readers.append(reader_address)
+            else:
+                yield wire_protocol.pack_frame(wire_protocol.ERROR, wire_protocol.pack_fields('Invalid signature', reader_address))
+        chunks = [readers[i:i + BATCH_CHUNK] for i in range(0, len(readers), BATCH_CHUNK)]
+        executor = self.keygen_executor
+        results = ((chunk, None) for chunk in chunks)
+        if executor is not None:
+            try:
+                futures = {executor.submit(authority_key_generation.generate_user_keys, self.authority_number,
+                                           process_instance_id, chunk): chunk for chunk in chunks}
+                results = ((futures[future], future) for future in as_completed(futures))
+            except BrokenProcessPool:
+                self.restart_keygen_pool(executor)
+        issued = 0
+        for chunk, result in results:
+            chunk_keys = None
+            if result is not None:
+                try:
+                    chunk_keys = result.result()
+                except BrokenProcessPool:
+                    # The chunk is generated here, the next batches use the new pool
+                    self.restart_keygen_pool(executor)
+                except Exception as e:
+                    chunk_keys = [(reader_address, None, str(e)) for reader_address in chunk]
+            if chunk_keys is None:
+                try:
+                    chunk_keys = authority_key_generation.generate_user_keys(self.authority_number, process_instance_id, chunk)
+                except Exception as e:
+                    chunk_keys = [(reader_address, None, str(e)) for reader_address in chunk]
+            for reader_address, user_sk1, error in chunk_keys:
+                if error is not None:
+                    yield wire_protocol.pack_frame(wire_protocol.ERROR, wire_protocol.pack_fields(error, reader_address))
+                    continue
+                issued += 1
+                yield wire_protocol.pack_frame(wire_protocol.BATCH_KEY, wire_protocol.pack_fields(reader_address, user_sk1))
+        yield wire_protocol.pack_frame(wire_protocol.BATCH_END, wire_protocol.pack_fields(str(issued)))
 
     # Generates a unique number for secure handshake
     def generate_number_to_sign(self, process_instance_id, reader_address):
-        connection = sqlite3.connect('../databases/authority'+str(self.authority_number)+'/authority'+str(self.authority_number)+'.db')
-        x = connection.cursor()
-        now = int(datetime.now().strftime("%Y%m%d%H%M%S%f"))
-        random.seed(now)
-        number_to_sign = random.randint(1, 2 ** 64)
-        x.execute("INSERT OR IGNORE INTO handshake_numbers VALUES (?,?,?)",
-                  (process_instance_id, reader_address, str(number_to_sign)))
-        connection.commit()
-        return number_to_sign
-
-    # Verifies the handshake using the Reader’s signature and IPFS-stored public key
-    def check_handshake(self, process_instance_id, reader_address, signature):
-        connection = sqlite3.connect('../databases/authority'+str(self.authority_number)+'/authority'+str(self.authority_number)+'.db')
-        x = connection.cursor()
-        x.execute("SELECT * FROM handshake_numbers WHERE process_instance=? AND reader_address=?",
-                  (process_instance_id, reader_address))
-        result = x.fetchall()
-        number_to_sign = result[0][2]
+        return self.nonces.issue(process_instance_id, reader_address)
+
+    # Verifies the handshake using the Reader’s signature and IPFS-stored public key,
+    # against the pending number of the nonce store or the one kept in the connection. A pending number is
+    # consumed only by a valid signature, so a request with a wrong one can not cancel the reader's handshake
+    def check_handshake(self, process_instance_id, reader_address, signature, number_to_sign=None):
+        pending = number_to_sign is None
+        if pending:
+            number_to_sign = self.nonces.number(process_instance_id, reader_address)
+            if number_to_sign is None:
+                print(f"No pending handshake for {reader_address}")
+                return False
         msg = str(number_to_sign).encode()
-        public_key_ipfs_link = block_int.retrieve_publicKey_readers(reader_address)
-        api = ipfshttpclient.connect('/ip4/127.0.0.1/tcp/5001')
-        getfile = api.cat(public_key_ipfs_link).split(b'###')
-        public_key_n = int(getfile[1].decode('utf-8'))
-        public_key_e = int(getfile[2].decode('utf-8').rstrip('"'))
-        if getfile[0].split(b': ')[1].decode('utf-8') == reader_address:
-            hash = int.from_bytes(sha512(msg).digest(), byteorder='big')
-            hashFromSignature = pow(int(signature), public_key_e, public_key_n)
-            print("Signature valid:", hash == hashFromSignature)
-            return hash == hashFromSignature
+        hash = int.from_bytes(sha512(msg).digest(), byteorder='big')
+        try:
+            (public_key_n, public_key_e), checked = self.public_keys.public_key(reader_address)
+            valid = hash == pow(int(signature), public_key_e, public_key_n)
+            if not valid and not checked:
+                # The reader may have published a new key since it was cached
+                (public_key_n, public_key_e), _ = self.public_keys.public_key(reader_address, refresh=True)
+                valid = hash == pow(int(signature), public_key_e, public_key_n)
+        except Exception as e:
+            print(f"Public key of {reader_address} not available: {e}")
+            return False
+        if valid and pending and not self.nonces.consume(process_instance_id, reader_address, number_to_sign):
+            print(f"Handshake number of {reader_address} already used")
+            return False
+        print("Signature valid:", valid)
+        return valid
 
-    # Manages client connections, processing handshake requests and key generation
+    # Processes a request of the legacy protocol, returning the reply or None
+    def process_message(self, msg):
+        message = msg.split('§')
+        if message[0] == "Auth-" + str(self.authority_number) + " - Start handshake":
+            number_to_sign = self.generate_number_to_sign(message[1], message[2])
+            return b'Number to sign: ' + str(number_to_sign).encode()
+        if message[0] == "Auth-" + str(self.authority_number) + " - Generate your part of my key":
+            if self.check_handshake(message[2], message[3], message[4]):
+                user_sk1 = self.generate_key_auth(message[1], message[2], message[3])
+                return b'Here is my partial key: ' + user_sk1
+        return None
+
+    # Processes a frame of the binary protocol, returning the reply frame, or an iterator of frames for a batch
+    # request. The session holds the state of the connection: the numbers to sign of the requests never leave it
+    def process_frame(self, message_type, payload, session):
+        fields = wire_protocol.unpack_fields(payload)
+        if message_type == wire_protocol.KEY_REQUEST and len(fields) == 2:
+            session['number_to_sign'] = (fields[0], fields[1], secrets.randbelow(2 ** 64) + 1)
+            return wire_protocol.pack_frame(wire_protocol.NUMBER_TO_SIGN, wire_protocol.pack_fields(str(session['number_to_sign'][2])))
+        if message_type == wire_protocol.SIGNED_KEY_REQUEST and len(fields) == 4:
+            gid, process_instance_id, reader_address, signature = fields
+            expected_process_instance_id, expected_reader_address, number_to_sign = session.pop('number_to_sign', (None, None, None))
+            if (expected_process_instance_id, expected_reader_address) != (process_instance_id, reader_address):
+                return wire_protocol.pack_frame(wire_protocol.ERROR, wire_protocol.pack_fields('No number to sign for this request'))
+            if not self.check_handshake(process_instance_id, reader_address, signature, number_to_sign):
+                return wire_protocol.pack_frame(wire_protocol.ERROR, wire_protocol.pack_fields('Invalid signature'))
+            # A failure is reported to the client, which does not retry it, instead of closing the connection
+            try:
+                user_sk1 = self.generate_key_auth(gid, process_instance_id, reader_address, raw=True)
+            except KeyError:
+                return wire_protocol.pack_frame(wire_protocol.ERROR, wire_protocol.pack_fields('No attributes certified for the reader'))
+            except Exception as e:
+                print(f"[KEY GENERATION FAILED] {reader_address}: {e}")
+                return wire_protocol.pack_frame(wire_protocol.ERROR, wire_protocol.pack_fields(f'Key generation failed: {e}'))
+            return wire_protocol.pack_frame(wire_protocol.PARTIAL_KEY, user_sk1)
+        if message_type == wire_protocol.BATCH_KEY_REQUEST and 1 < len(fields) <= MAX_BATCH + 1:
+            numbers = {reader_address: str(secrets.randbelow(2 ** 64) + 1) for reader_address in fields[1:]}
+            session['batch_numbers'] = (fields[0], numbers)
+            return wire_protocol.pack_frame(wire_protocol.BATCH_NUMBERS_TO_SIGN,
+                                            wire_protocol.pack_fields(*[value for item in numbers.items() for value in item]))
+        if message_type == wire_protocol.BATCH_SIGNED_KEY_REQUEST and len(fields) % 2 == 1:
+            expected_process_instance_id, numbers = session.pop('batch_numbers', (None, {}))
+            if expected_process_instance_id != fields[0]:
+                return wire_protocol.pack_frame(wire_protocol.ERROR, wire_protocol.pack_fields('No numbers to sign for this request'))
+            return self.generate_keys_batch(fields[0], numbers, list(zip(fields[1::2], fields[2::2])))
+        return wire_protocol.pack_frame(wire_protocol.ERROR, wire_protocol.pack_fields('Unsupported message'))
+
+    # Manages client connections, processing handshake requests and key generation. Binary frames
+    # and legacy messages are told apart by their first bytes, and a connection serves any number of requests
     def handle_client(self, conn, addr):
         print(f"[NEW CONNECTION] {addr} connected")
-        connected = True
-        while connected:
-            msg_length = conn.recv(int(HEADER)).decode(FORMAT)
-            if msg_length:
-                msg_length = int(msg_length)
-                msg = conn.recv(msg_length).decode(FORMAT)
+        # Connections stay open across requests until the client disconnects or stays idle too long
+        conn.settimeout(IDLE_TIMEOUT)
+        session = {}
+        reader = wire_protocol.FrameReader(conn)
+        try:
+            while True:
+                prefix = bytes(reader.read_into(len(wire_protocol.MAGIC)))
+                if prefix == wire_protocol.MAGIC:
+                    message_type, payload = reader.read_frame(prefix)
+                    if message_type == wire_protocol.DISCONNECT:
+                        break
+                    reply = self.process_frame(message_type, payload, session)
+                    for frame in ([reply] if isinstance(reply, bytes) else reply):
+                        conn.sendall(frame)
+                    continue
+                msg_length = int((prefix + bytes(reader.read_into(int(HEADER) - len(prefix)))).decode(FORMAT))
+                msg = bytes(reader.read_into(msg_length)).decode(FORMAT)
                 if msg == DISCONNECT_MESSAGE:
-                    connected = False
-                message = msg.split('§')
-                if message[0] == "Auth-" + str(self.authority_number) + " - Start handshake":
-                    number_to_sign = self.generate_number_to_sign(message[1], message[2])
-                    conn.send(b'Number to sign: ' + str(number_to_sign).encode())
-                if message[0] == "Auth-" + str(self.authority_number) + " - Generate your part of my key":
-                    if self.check_handshake(message[2], message[3], message[4]):
-                        user_sk1 = self.generate_key_auth(message[1], message[2], message[3])
-                        conn.send(b'Here is my partial key: ' + user_sk1)
+                    break
+                reply = self.process_message(msg)
+                if reply is not None:
+                    conn.sendall(reply)
+        except Exception as e:
+            print(f"[CONNECTION CLOSED] {addr}: {e}")
         conn.close()
 
-    # Starts the listening for incoming client connections
-    def start(self):
+    # Manages a client connection of the asyncio server: the socket I/O runs on the event loop,
+    # the database, chain, IPFS and key generation work on the executor
+    async def handle_client_async(self, reader, writer, executor, connections):
+        addr = writer.get_extra_info('peername')
+        # The limit is checked before the TLS handshake: a connection over it is closed at once
+        if connections.locked():
+            print(f"[REJECTED] {addr}: too many connections")
+            writer.close()
+            return
+        async with connections:
+            print(f"[NEW CONNECTION] {addr} connected")
+            loop = asyncio.get_running_loop()
+            session = {}
+            try:
+                await writer.start_tls(context, ssl_handshake_timeout=IDLE_TIMEOUT)
+                while True:
+                    prefix = await asyncio.wait_for(reader.readexactly(len(wire_protocol.MAGIC)), IDLE_TIMEOUT)
+                    if prefix == wire_protocol.MAGIC:
+                        header = prefix + await reader.readexactly(wire_protocol.FRAME_HEADER.size - len(prefix))
+                        _, message_type, length = wire_protocol.FRAME_HEADER.unpack(header)
+                        if length > wire_protocol.MAX_PAYLOAD or message_type == wire_protocol.DISCONNECT:
+                            break
+                        payload = await reader.readexactly(length)
+                        reply = await loop.run_in_executor(executor, self.process_frame, message_type, payload, session)
+                        if not isinstance(reply, bytes):
+                            # A batch reply is streamed: every frame is generated on the executor and flushed
+                            frame = await loop.run_in_executor(executor, next, reply, None)
+                            while frame is not None:
+                                writer.write(frame)
+                                await writer.drain()
+                                frame = await loop.run_in_executor(executor, next, reply, None)
+                            continue
+                    else:
+                        header = prefix + await reader.readexactly(int(HEADER) - len(prefix))
+                        msg = (await reader.readexactly(int(header.decode(FORMAT)))).decode(FORMAT)
+                        if msg == DISCONNECT_MESSAGE:
+                            break
+                        reply = await loop.run_in_executor(executor, self.process_message, msg)
+                    if reply is not None:
+                        writer.write(reply)
+                        # Backpressure: do not read further requests until the reply is flushed
+                        await writer.drain()
+            except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError, ssl.SSLError):
+                pass
+            except Exception as e:
+                print(f"[CONNECTION CLOSED] {addr}: {e}")
+            finally:
+                writer.close()
+
+    # Starts the asyncio server, serving at most max_connections clients at the same time. The TLS handshake
+    # is done by the handler, so it is bounded by the limit too
+    async def start_async(self, workers, max_connections):
+        executor = ThreadPoolExecutor(max_workers=workers)
+        connections = asyncio.Semaphore(max_connections)
+        server = await asyncio.start_server(
+            lambda reader, writer: self.handle_client_async(reader, writer, executor, connections),
+            SERVER, PORT, backlog=max_connections)
+        print(f"[LISTENING] Server is listening on {SERVER} with asyncio, {workers} workers and {max_connections} connections")
+        async with server:
+            await server.serve_forever()
+
+    # Loads the key generation context of a process instance before the first request
+    def preload(self, process_instance_id):
+        try:
+            authority_context = authority_key_generation.authority_context(self.authority_number, process_instance_id)
+            print(f"[PRELOADED] Process instance {process_instance_id}")
+            # The readers' public keys can not be enumerated on chain, warm the ones of the readers with attributes
+            loaded = self.public_keys.warm(authority_context.attributes.keys())
+            print(f"[PRELOADED] {loaded} reader public keys")
+        except Exception as e:
+            print(f"[PRELOAD FAILED] Process instance {process_instance_id}: {e}")
+
+    # Completes the TLS handshake and serves the connection on a worker of the pool
+    def serve_connection(self, newsocket, fromaddr, free_workers):
+        # The worker is given back however the connection ends, a client that never completes
+        # the TLS handshake holds it for at most IDLE_TIMEOUT
+        try:
+            newsocket.settimeout(IDLE_TIMEOUT)
+            try:
+                conn = context.wrap_socket(newsocket, server_side=True)
+            except (ssl.SSLError, OSError) as e:
+                print(f"[TLS FAILED] {fromaddr}: {e}")
+                newsocket.close()
+                return
+            self.handle_client(conn, fromaddr)
+        finally:
+            free_workers.release()
+
+    # Starts the listening for incoming client connections, served by a bounded pool of workers. A connection
+    # holds its worker until it is closed or idle for IDLE_TIMEOUT, so a connection is accepted only when a
+    # worker is free: the others wait in the listen backlog instead of the queue of the pool
+    def start(self, workers):
         bindsocket.listen()
-        print(f"[LISTENING] Server is listening on {SERVER}")
-        while True:
-            newsocket, fromaddr = bindsocket.accept()
-            conn = context.wrap_socket(newsocket, server_side=True)
-            thread = threading.Thread(target=self.handle_client, args=(conn, fromaddr))
-            thread.start()
-            print(f"[ACTIVE CONNECTIONS] {threading.active_count() - 1}")
+        print(f"[LISTENING] Server is listening on {SERVER} with {workers} workers")
+        free_workers = threading.BoundedSemaphore(workers)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                free_workers.acquire()
+                try:
+                    newsocket, fromaddr = bindsocket.accept()
+                except OSError as e:
+                    free_workers.release()
+                    print(f"[ACCEPT FAILED] {e}")
+                    continue
+                executor.submit(self.serve_connection, newsocket, fromaddr, free_workers)
 
 if __name__ == "__main__":
     authorities_names = authorities_names()
@@ -94,6 +379,16 @@ if __name__ == "__main__":
     print("[STARTING] server is starting...")
     parser = argparse.ArgumentParser(description='Authority')
     parser.add_argument('-a', '--authority', type=int, help='Authority number')
+    parser.add_argument('-w', '--workers', type=int, default=8, help='Connections served at the same time by the worker pool, requests processed at the same time with asyncio')
+    parser.add_argument('--asyncio', action='store_true', help='Serve the connections with an asyncio event loop')
+    parser.add_argument('-m', '--max_connections', type=int, default=256, help='Connections open at the same time in asyncio mode')
+    parser.add_argument('--idle_timeout', type=float, default=30, help='Seconds an idle client connection is kept open, with the worker pool '
+                                                                       'an idle connection holds a worker')
+    parser.add_argument('--persist_nonces', action='store_true', help='Mirror the pending handshake numbers to the database')
+    parser.add_argument('-k', '--keygen_workers', type=int, default=0, help='Processes generating the keys of the batch requests, 0 to generate them on the request worker')
+    parser.add_argument('--public_key_ttl', type=float, default=10, help='Seconds a cached reader public key is accepted before its link is checked again on chain')
+    parser.add_argument('--attributes_ttl', type=float, default=60, help='Seconds after which the certified attributes are checked again on chain')
+    parser.add_argument('--max_batch', type=int, default=1000, help='Readers accepted in a batch key request')
     args = parser.parse_args()
     if args.authority < 1 or args.authority > number_of_authorities:
         print("Invalid authority number")
@@ -113,12 +408,21 @@ if __name__ == "__main__":
     context.verify_mode = ssl.CERT_REQUIRED
     context.load_cert_chain(certfile=server_cert, keyfile=server_key)
     context.load_verify_locations(cafile=client_certs)
-    bindsocket = socket.socket()
-    bindsocket.bind(ADDR)
-    bindsocket.listen(5)
+    IDLE_TIMEOUT = args.idle_timeout
+    MAX_BATCH = args.max_batch
+    authority_key_generation.AuthorityContext.attributes_ttl = args.attributes_ttl
+    BATCH_CHUNK = 16
     
     # Initialize the Authority with the specified Authority number
     authority_number = args.authority
-    authority_server = AuthorityServer(args.authority)
-    authority_server.start()
+    authority_server = AuthorityServer(args.authority, args.persist_nonces, args.public_key_ttl)
+    authority_server.preload(config('PROCESS_INSTANCE_ID'))
+    authority_server.start_keygen_pool(args.keygen_workers)
+    if args.asyncio:
+        asyncio.run(authority_server.start_async(args.workers, args.max_connections))
+    else:
+        bindsocket = socket.socket()
+        bindsocket.bind(ADDR)
+        bindsocket.listen(5)
+        authority_server.start(args.workers)
 
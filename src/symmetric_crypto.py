@@ -0,0 +1,127 @@
+import hmac
+import struct
+from hashlib import sha256
+from Crypto.Cipher import AES
+from Crypto.Random import get_random_bytes
+
+# Encrypted files are a header (magic, nonce prefix) followed by AES-GCM chunks, each one stored as
+# length (the top bit marks the last chunk), ciphertext and tag. The nonce of a chunk is the prefix,
+# the chunk counter and the last-chunk flag, so reordered, dropped or truncated chunks fail authentication.
+MAGIC = b'CGS1'
+CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 16 * 1024 * 1024
+PREFIX_LENGTH = 7
+TAG_LENGTH = 16
+LAST_CHUNK = 1 << 31
+
+
+def derive_key(key_material, context, length=32):
+    """
+    Derive a symmetric key from the serialization of a GT key with HKDF-SHA256 (RFC 5869)
+    :param key_material: The serialized GT element.
+    :param context: The value binding the derived key to its use, e.g. the slice id.
+    :param length: The length of the derived key in bytes.
+    :return: The derived key.
+    """
+    pseudorandom_key = hmac.new(b'CGS key derivation', key_material, sha256).digest()
+    info = str(context).encode('utf-8')
+    output, block, counter = b'', b'', 1
+    while len(output) < length:
+        block = hmac.new(pseudorandom_key, block + info + bytes([counter]), sha256).digest()
+        output += block
+        counter += 1
+    return output[:length]
+
+
+def chunk_nonce(prefix, counter, last):
+    return prefix + struct.pack('>IB', counter, last)
+
+
+def read_exactly(source, length):
+    """
+    Read exactly length bytes from a file-like object
+    """
+    data = bytearray()
+    while len(data) < length:
+        block = source.read(length - len(data))
+        if not block:
+            raise Exception("Encrypted file is truncated")
+        data += block
+    return bytes(data)
+
+
+def encrypt_stream(key_material, source, destination, chunk_size=CHUNK_SIZE):
+    """
+    Encrypt a file chunk by chunk with AES-256-GCM, keeping at most two chunks in memory.
+    :param key_material: The serialized GT key (or a key derived from it); its SHA-256 is the AES key.
+    :param source: The binary file-like object to encrypt.
+    :param destination: The binary file-like object receiving the encrypted file.
+    :param chunk_size: The size of the plaintext chunks.
+    """
+    key = sha256(key_material).digest()
+    prefix = get_random_bytes(PREFIX_LENGTH)
+    destination.write(MAGIC + prefix)
+    counter = 0
+    chunk = source.read(chunk_size)
+    while True:
+        following = source.read(chunk_size)
+        last = not following
+        cipher = AES.new(key, AES.MODE_GCM, nonce=chunk_nonce(prefix, counter, last))
+        ciphertext, tag = cipher.encrypt_and_digest(chunk)
+        destination.write(struct.pack('>I', len(ciphertext) | (LAST_CHUNK if last else 0)))
+        destination.write(ciphertext)
+        destination.write(tag)
+        if last:
+            return
+        chunk = following
+        counter += 1
+
+
+def decrypt_stream(key_material, source, destination):
+    """
+    Decrypt a file written by encrypt_stream chunk by chunk, verifying every chunk before writing it.
+    :param key_material: The key material used for the encryption.
+    :param source: The binary file-like object to decrypt.
+    :param destination: The binary file-like object receiving the plaintext.
+    :raise Exception: When the file is not an encrypted file, is truncated or fails authentication.
+    """
+    key = sha256(key_material).digest()
+    header = read_exactly(source, len(MAGIC) + PREFIX_LENGTH)
+    if header[:len(MAGIC)] != MAGIC:
+        raise Exception("Not an encrypted file")
+    prefix = header[len(MAGIC):]
+    counter = 0
+    while True:
+        (length,) = struct.unpack('>I', read_exactly(source, 4))
+        last = bool(length & LAST_CHUNK)
+        length &= ~LAST_CHUNK
+        if length > MAX_CHUNK_SIZE:
+            raise Exception("Invalid chunk length in encrypted file")
+        data = read_exactly(source, length + TAG_LENGTH)
+        cipher = AES.new(key, AES.MODE_GCM, nonce=chunk_nonce(prefix, counter, last))
+        destination.write(cipher.decrypt_and_verify(data[:length], data[length:]))
+        if last:
+            break
+        counter += 1
+    if source.read(1):
+        raise Exception("Unexpected data after the last chunk of the encrypted file")
+
+
+def write_slice(key_material, ciphered_key, source, destination, chunk_size=CHUNK_SIZE):
+    """
+    Write a slice object: the length of the ciphered key, the ciphered key and the encrypted file.
+    :param ciphered_key: The serialized ABE ciphertext of the key, empty when the key is stored in its own object.
+    """
+    destination.write(struct.pack('>I', len(ciphered_key)) + ciphered_key)
+    encrypt_stream(key_material, source, destination, chunk_size)
+
+
+def read_slice_key(source):
+    """
+    Read the ciphered key at the start of a slice object, leaving source at the encrypted file
+    :return: The serialized ABE ciphertext of the key, empty when the key is stored in its own object.
+    """
+    (length,) = struct.unpack('>I', read_exactly(source, 4))
+    if length > MAX_CHUNK_SIZE:
+        raise Exception("Invalid key length in slice")
+    return read_exactly(source, length)
@@ -0,0 +1,155 @@
+import struct
+import base64
+
+# Binary framing of the Authority protocol. A frame is the magic (with the protocol version), the message
+# type, the payload length and the payload. The magic can not start a legacy frame, whose header is the
+# ASCII length of the message padded with spaces, so a server can serve both on the same port.
+MAGIC = b'CGW\x01'
+FRAME_HEADER = struct.Struct('>4sBI')
+MAX_PAYLOAD = 16 * 1024 * 1024
+MAX_FIELD = 0xFFFF
+
+KEY_REQUEST = 1
+NUMBER_TO_SIGN = 2
+SIGNED_KEY_REQUEST = 3
+PARTIAL_KEY = 4
+ERROR = 5
+DISCONNECT = 6
+BATCH_KEY_REQUEST = 7
+BATCH_NUMBERS_TO_SIGN = 8
+BATCH_SIGNED_KEY_REQUEST = 9
+BATCH_KEY = 10
+BATCH_END = 11
+
+
+def pack_frame(message_type, payload=b''):
+    return FRAME_HEADER.pack(MAGIC, message_type, len(payload)) + payload
+
+
+def pack_fields(*fields):
+    """
+    Encode a list of strings or bytes as length-prefixed fields
+    """
+    data = []
+    for field in fields:
+        if isinstance(field, str):
+            field = field.encode('utf-8')
+        if len(field) > MAX_FIELD:
+            raise Exception("Field too large for a frame")
+        data.append(struct.pack('>H', len(field)) + field)
+    return b''.join(data)
+
+
+def read_field(payload, position):
+    """
+    Return the length-prefixed field at position and the position after it
+    :raise ValueError: When the field does not fit in the payload.
+    """
+    if position + 2 > len(payload):
+        raise ValueError("Truncated field in frame")
+    (length,) = struct.unpack_from('>H', payload, position)
+    position += 2 + length
+    if position > len(payload):
+        raise ValueError("Truncated field in frame")
+    return bytes(payload[position - length:position]), position
+
+
+def unpack_fields(payload, decode=True):
+    """
+    Decode the length-prefixed fields of a payload, as strings or, without decode, as bytes
+    """
+    fields = []
+    position = 0
+    while position < len(payload):
+        field, position = read_field(payload, position)
+        fields.append(field.decode('utf-8') if decode else field)
+    return fields
+
+
+def raw_element(group, element):
+    # The group serialization is the element type and the base64 of the compressed point, keep them in binary
+    element_type, encoded = group.serialize(element).split(b':', 1)
+    return bytes([int(element_type)]) + base64.b64decode(encoded)
+
+
+def element_from_raw(group, raw):
+    return group.deserialize(b'%d:' % raw[0] + base64.b64encode(bytes(raw[1:])))
+
+
+def encode_key(group, user_key):
+    """
+    Encode the keys of a user, a dictionary from attribute to {'K', 'KP'}, with raw compressed points
+    """
+    data = [struct.pack('>H', len(user_key))]
+    for attribute, key in user_key.items():
+        data.append(pack_fields(attribute, raw_element(group, key['K']), raw_element(group, key['KP'])))
+    return b''.join(data)
+
+
+def decode_key(group, payload):
+    """
+    Decode the keys of a user written by encode_key
+    :raise ValueError: When the payload is truncated, has trailing data or an empty element.
+    """
+    if len(payload) < 2:
+        raise ValueError("Truncated field in frame")
+    (count,) = struct.unpack_from('>H', payload, 0)
+    position = 2
+    user_key = {}
+    for _ in range(count):
+        values = []
+        for _ in range(3):
+            value, position = read_field(payload, position)
+            values.append(value)
+        if not values[1] or not values[2]:
+            raise ValueError("Empty group element in frame")
+        user_key[values[0].decode('utf-8')] = {'K': element_from_raw(group, values[1]),
+                                               'KP': element_from_raw(group, values[2])}
+    if position != len(payload):
+        raise ValueError("Trailing data after the key in frame")
+    return user_key
+
+
+class FrameReader:
+    """
+    Reads frames from a socket with recv_into a preallocated buffer. The payload returned by
+    read_frame is a view of the buffer, valid until the next read.
+    """
+
+
+    def __init__(self, sock, size=64 * 1024):
+        self.sock = sock
+        self.buffer = bytearray(size)
+
+
+    def read_into(self, length, offset=0):
+        if offset + length > len(self.buffer):
+            buffer = bytearray(offset + length)
+            buffer[:offset] = self.buffer[:offset]
+            self.buffer = buffer
+        view = memoryview(self.buffer)
+        received = offset
+        while received < offset + length:
+            count = self.sock.recv_into(view[received:offset + length])
+            if count == 0:
+                raise ConnectionError("Connection closed by the peer")
+            received += count
+        return view[offset:offset + length]
+
+
+    def read_frame(self, magic=None):
+        """
+        Read a frame, returning its type and payload.
+        :param magic: The first bytes of the frame, if they were already read to detect the protocol.
+        """
+        if magic is None:
+            self.read_into(FRAME_HEADER.size)
+        else:
+            self.buffer[:len(magic)] = magic
+            self.read_into(FRAME_HEADER.size - len(magic), len(magic))
+        frame_magic, message_type, length = FRAME_HEADER.unpack_from(self.buffer, 0)
+        if frame_magic != MAGIC:
+            raise Exception("Unsupported protocol version")
+        if length > MAX_PAYLOAD:
+            raise Exception("Frame too large")
+        return message_type, self.read_into(length)
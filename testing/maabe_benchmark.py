@@ -0,0 +1,121 @@
+import sys
+import time
+import argparse
+
+sys.path.append('../src')
+
+from charm.toolbox.pairinggroup import *
+from maabe_class import *
+from policy_plus import policy_plus
+
+
+def clone(groupObj, values):
+    # Copy a dictionary of group elements, dropping any precomputation table attached to them
+    return {k: groupObj.deserialize(groupObj.serialize(v)) if isinstance(v, pc_element) else v
+            for k, v in values.items()}
+
+
+def setup_authorities(groupObj, maabe, number_of_authorities):
+    # Generate global parameters and Authority key pairs in memory, without chain or IPFS
+    public_parameters = maabe.setup(groupObj.random(G1), groupObj.random(G2))
+    pks, sks = {}, {}
+    for i in range(number_of_authorities):
+        name = f'AUTH{i + 1}'
+        pks[name], sks[name] = maabe.authsetup(public_parameters, name)
+    return public_parameters, pks, sks
+
+
+def conjunction_policy(leaves, number_of_authorities):
+    # Build an AND policy with the given number of leaves spread across the Authorities
+    return ' and '.join(f'ATTR{i}@AUTH{i % number_of_authorities + 1}' for i in range(leaves))
+
+
+def time_encryption(groupObj, maabe, public_parameters, pks, policy, rounds):
+    # Average time of an encryption of a random GT key under the policy
+    start = time.perf_counter()
+    for _ in range(rounds):
+        maabe.encrypt(public_parameters, pks, groupObj.random(GT), policy)
+    return (time.perf_counter() - start) / rounds
+
+
+def bench_precomputation(groupObj, maabe, number_of_authorities, leaf_counts, rounds):
+    # Compare encryption with and without the fixed-base tables as the leaf count grows
+    public_parameters, pks, _ = setup_authorities(groupObj, maabe, number_of_authorities)
+    print(f"{'leaves':>8} {'plain (ms)':>12} {'precomputed (ms)':>18} {'speedup':>9}")
+    for leaves in leaf_counts:
+        policy = conjunction_policy(leaves, number_of_authorities)
+        plain_pp = clone(groupObj, public_parameters)
+        plain_pks = {name: clone(groupObj, pk) for name, pk in pks.items()}
+        plain = time_encryption(groupObj, maabe, plain_pp, plain_pks, policy, rounds)
+        fast_pp = clone(groupObj, public_parameters)
+        fast_pks = {name: clone(groupObj, pk) for name, pk in pks.items()}
+        maabe.precompute(fast_pp, fast_pks)
+        fast = time_encryption(groupObj, maabe, fast_pp, fast_pks, policy, rounds)
+        print(f'{leaves:>8} {plain * 1000:>12.2f} {fast * 1000:>18.2f} {plain / fast:>8.2f}x')
+
+
+def user_secret_key(maabe, public_parameters, sks, gid, attributes):
+    # Generate the merged secret key of a user holding the given attributes
+    keys = {}
+    for attribute in attributes:
+        _, auth, _ = maabe.unpack_attribute(attribute)
+        keys[attribute] = maabe.keygen(public_parameters, sks[auth], gid, attribute)
+    return {'GID': gid, 'keys': keys}
+
+
+def bench_satisfying_set(groupObj, maabe, number_of_authorities, leaf_counts, rounds):
+    # Compare the first satisfying set with the cheapest one on a policy whose first clause is the largest
+    public_parameters, pks, sks = setup_authorities(groupObj, maabe, number_of_authorities)
+    mandatory = ' and '.join(f'PID@AUTH{i + 1}' for i in range(number_of_authorities))
+    print(f"{'leaves':>8} {'first (ms)':>12} {'cheapest (ms)':>15} {'speedup':>9}")
+    for leaves in leaf_counts:
+        policy = f'({mandatory}) and (({conjunction_policy(leaves, number_of_authorities)}) or SHORT@AUTH1)'
+        attributes = [f'PID@AUTH{i + 1}' for i in range(number_of_authorities)] + ['SHORT@AUTH1'] + \
+                     [f'ATTR{i}@AUTH{i % number_of_authorities + 1}' for i in range(leaves)]
+        user_sk = user_secret_key(maabe, public_parameters, sks, 'reader', attributes)
+        ct = maabe.encrypt(public_parameters, pks, groupObj.random(GT), policy)
+        timings = []
+        for cheapest in (False, True):
+            start = time.perf_counter()
+            for _ in range(rounds):
+                maabe.decrypt(public_parameters, user_sk, ct, cheapest)
+            timings.append((time.perf_counter() - start) / rounds)
+        print(f'{leaves:>8} {timings[0] * 1000:>12.2f} {timings[1] * 1000:>15.2f} {timings[0] / timings[1]:>8.2f}x')
+
+
+def bench_threshold(groupObj, maabe, number_of_authorities, leaf_counts, rounds):
+    # Compare the DNF expansion of NAME@k+ with the native threshold gate, for every 1 < k < n
+    public_parameters, pks, _ = setup_authorities(groupObj, maabe, number_of_authorities)
+    maabe.precompute(public_parameters, pks)
+    print(f"{'k':>4} {'DNF leaves':>11} {'DNF (ms)':>10} {'gate leaves':>12} {'gate (ms)':>10}")
+    for k in range(2, number_of_authorities):
+        results = []
+        for threshold in (False, True):
+            policy = policy_plus(f'NAME@{k}+', number_of_authorities, threshold)
+            leaves = len(maabe.util.getAttributeList(maabe.util.createPolicy(policy)))
+            results.extend([leaves, time_encryption(groupObj, maabe, public_parameters, pks, policy, rounds)])
+        print(f'{k:>4} {results[0]:>11} {results[1] * 1000:>10.2f} {results[2]:>12} {results[3] * 1000:>10.2f}')
+
+
+benchmarks = {
+    'precompute': ('Fixed-base precomputation for encrypt', bench_precomputation),
+    'planner': ('Satisfying set selection for decrypt', bench_satisfying_set),
+    'threshold': ('Threshold gates against DNF expansion in encrypt', bench_threshold),
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='MA-ABE benchmarks')
+    parser.add_argument('-a', '--authorities', type=int, default=4, help='Number of Authorities')
+    parser.add_argument('-l', '--leaves', type=int, nargs='+', default=[1, 4, 16, 32, 64, 128],
+                        help='Policy leaf counts to measure')
+    parser.add_argument('-r', '--rounds', type=int, default=5, help='Repetitions per measurement')
+    parser.add_argument('-b', '--bench', type=str, nargs='+', choices=list(benchmarks), default=list(benchmarks),
+                        help='Benchmarks to run')
+    args = parser.parse_args()
+    groupObj = PairingGroup('SS512')
+    maabe = MaabeRW15(groupObj)
+    for name in args.bench:
+        title, bench = benchmarks[name]
+        print(title)
+        bench(groupObj, maabe, args.authorities, args.leaves, args.rounds)
@@ -0,0 +1,16 @@
+import os
+import base64
+import sys
+
+# The modules of the project are run from src, as scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+
+class SerializingGroup:
+    # Serializes elements as the pairing group does: the element type and the base64 of the point
+    def serialize(self, element):
+        return b'%d:' % element[0] + base64.b64encode(element[1])
+
+    def deserialize(self, data):
+        element_type, encoded = data.split(b':', 1)
+        return int(element_type), base64.b64decode(encoded)
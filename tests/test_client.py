@@ -0,0 +1,110 @@
+import sqlite3
+import pytest
+
+pytest.importorskip('decouple')
+pytest.importorskip('charm.toolbox.pairinggroup')
+import client
+from nonce_store import NonceStore
+
+
+@pytest.fixture
+def connection(monkeypatch):
+    connection = sqlite3.connect(':memory:')
+    connection.execute("CREATE TABLE handshake_number (process_instance TEXT, reader_address TEXT, authority_name TEXT, "
+                       "number_to_sign TEXT, primary key (process_instance, reader_address, authority_name))")
+    connection.execute("CREATE TABLE authorities_generated_decription_keys (process_instance TEXT, reader_address TEXT, "
+                       "authority_name TEXT, decription_key TEXT, primary key (process_instance, reader_address, authority_name))")
+    # The globals set by the command line of the client
+    monkeypatch.setattr(client, 'connection', connection, raising=False)
+    monkeypatch.setattr(client, 'x', connection.cursor(), raising=False)
+    monkeypatch.setattr(client, 'process_instance_id', 1, raising=False)
+    monkeypatch.setattr(client, 'reader_address', '0xreader', raising=False)
+    monkeypatch.setattr(client, 'sign', lambda number_to_sign: number_to_sign)
+    yield connection
+    connection.close()
+
+
+def test_two_handshakes_in_a_row(connection):
+    nonces = NonceStore()
+    client.store_number_to_sign('Auth-1', nonces.issue(1, '0xreader'))
+    client.store_number_to_sign('Auth-1', nonces.issue(1, '0xreader'))
+    # The client signs the number the Authority is waiting for, not the replaced one
+    assert nonces.consume(1, '0xreader', client.sign_number('Auth-1'))
+
+
+def test_handshake_after_a_used_number(connection):
+    nonces = NonceStore()
+    client.store_number_to_sign('Auth-1', nonces.issue(1, '0xreader'))
+    assert nonces.consume(1, '0xreader', client.sign_number('Auth-1'))
+    client.store_number_to_sign('Auth-1', nonces.issue(1, '0xreader'))
+    assert nonces.consume(1, '0xreader', client.sign_number('Auth-1'))
+
+
+def test_number_is_dropped_with_the_key(connection):
+    client.store_number_to_sign('Auth-1', '42')
+    client.store_partial_key('Auth-1', 'partial key')
+    assert connection.execute("SELECT * FROM handshake_number").fetchall() == []
+    assert connection.execute("SELECT decription_key FROM authorities_generated_decription_keys").fetchall() == [('partial key',)]
+    with pytest.raises(Exception, match='No handshake'):
+        client.sign_number('Auth-1')
+
+
+class FakeConnection:
+    session = None
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setattr(client, 'authorities_names', lambda: ['AUTH1'])
+    monkeypatch.setattr(client.time, 'sleep', lambda seconds: None)
+    pool = client.AuthorityConnectionPool(1)
+    pool.opened = []
+
+    def connect(authority_number):
+        pool.opened.append(authority_number)
+        return FakeConnection(), None
+    pool.connect = connect
+    return pool
+
+
+def failing(*errors):
+    # A request raising the errors in order, then returning the number of calls
+    calls = []
+
+    def request(tls_conn, frame_reader, authority_name):
+        calls.append(authority_name)
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return len(calls)
+    return request
+
+
+def test_stale_pooled_connection_is_replaced(pool):
+    pool.exchange(1, failing())
+    assert pool.exchange(1, failing(ConnectionResetError())) == 2
+    assert pool.opened == [1, 1]
+
+
+def test_failure_on_a_new_connection_is_raised(pool):
+    with pytest.raises(ConnectionResetError):
+        pool.exchange(1, failing(ConnectionResetError()))
+    assert pool.opened == [1]
+
+
+def test_batch_requests_are_retried(pool, monkeypatch):
+    monkeypatch.setattr(client, 'config', lambda name: '0x' + name)
+    monkeypatch.setattr(client, 'reader_private_key', lambda address: 'private key of ' + address)
+    monkeypatch.setattr(client, 'store_keys', lambda keys, process_instance_id, address: None)
+    replies = [TimeoutError(), ({'0xREADER_ADDRESS': 'key'}, {})]
+
+    def request_keys_batch(tls_conn, frame_reader, authority_name, private_keys, process_instance_id):
+        reply = replies.pop(0)
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+    monkeypatch.setattr(client, 'request_keys_batch', request_keys_batch)
+    keys, errors = client.acquire_keys_batch(pool, [1], ['READER'], 1, 1)
+    assert keys == {'0xREADER_ADDRESS': {'Auth-1': 'key'}} and errors == {}
@@ -0,0 +1,73 @@
+import pytest
+
+pytest.importorskip('charm.toolbox.pairinggroup')
+from charm.toolbox.pairinggroup import PairingGroup, G1, G2, GT
+from maabe_class import MaabeRW15
+
+GID = '0xreader'
+
+# Policy, attributes satisfying it, attributes not satisfying it
+POLICIES = [
+    ('A@AUTH1 and B@AUTH2', ['A@AUTH1', 'B@AUTH2'], ['A@AUTH1', 'C@AUTH2']),
+    ('A@AUTH1 or B@AUTH2', ['B@AUTH2'], ['C@AUTH1', 'C@AUTH2']),
+    ('(A@AUTH1 or C@AUTH1) and (B@AUTH2 or (C@AUTH2 and D@AUTH2))', ['C@AUTH1', 'C@AUTH2', 'D@AUTH2'],
+     ['A@AUTH1', 'C@AUTH1', 'C@AUTH2']),
+    ('2 of (A@AUTH1, B@AUTH2, C@AUTH2)', ['A@AUTH1', 'C@AUTH2'], ['C@AUTH2', 'D@AUTH2']),
+    ('(A@AUTH1 and B@AUTH2) or (A@AUTH1 and C@AUTH2)', ['A@AUTH1', 'C@AUTH2'], ['A@AUTH1', 'D@AUTH2']),
+    ('A@AUTH1 and (2 of (A@AUTH1, B@AUTH2, C@AUTH2) or D@AUTH2)', ['A@AUTH1', 'B@AUTH2'], ['B@AUTH2', 'C@AUTH2']),
+]
+
+
+@pytest.fixture(scope='module', params=[False, True], ids=['plain', 'precomputed'])
+def scheme(request):
+    group = PairingGroup('SS512')
+    maabe = MaabeRW15(group)
+    gp = maabe.setup(group.random(G1), group.random(G2))
+    pks, sks = {}, {}
+    for name in ['AUTH1', 'AUTH2']:
+        pks[name], sks[name] = maabe.authsetup(gp, name)
+        if request.param:
+            maabe.precompute_authority(gp, sks[name])
+    if request.param:
+        maabe.precompute(gp, pks)
+    return group, maabe, gp, pks, sks
+
+
+def user_key(maabe, gp, sks, attributes, keygen):
+    keys = {}
+    for name, sk in sks.items():
+        owned = [attribute for attribute in attributes if attribute.endswith('@' + name)]
+        if keygen == 'keygen':
+            keys.update({attribute: maabe.keygen(gp, sk, GID, attribute) for attribute in owned})
+        elif keygen == 'user_base':
+            base = maabe.user_base(gp, sk, GID)
+            keys.update({attribute: maabe.keygen(gp, sk, GID, attribute, base) for attribute in owned})
+        elif keygen == 'multiple_attributes':
+            keys.update(maabe.multiple_attributes_keygen(gp, sk, GID, owned))
+        else:
+            keys.update(maabe.multiple_users_keygen(gp, sk, {GID: owned, '0xother': owned})[GID])
+    return {'GID': GID, 'keys': keys}
+
+
+@pytest.mark.parametrize('keygen', ['keygen', 'user_base', 'multiple_attributes', 'multiple_users'])
+@pytest.mark.parametrize('cheapest', [True, False])
+@pytest.mark.parametrize('policy, attributes, missing', POLICIES)
+def test_decrypt_round_trip(scheme, policy, attributes, missing, cheapest, keygen):
+    group, maabe, gp, pks, sks = scheme
+    message = group.random(GT)
+    ct = maabe.encrypt(gp, pks, message, policy)
+    assert maabe.decrypt(gp, user_key(maabe, gp, sks, attributes, keygen), ct, cheapest) == message
+    # A key of every attribute of the policy decrypts too, with any satisfying set
+    everything = ['A@AUTH1', 'C@AUTH1', 'B@AUTH2', 'C@AUTH2', 'D@AUTH2']
+    assert maabe.decrypt(gp, user_key(maabe, gp, sks, everything, keygen), ct, cheapest) == message
+    with pytest.raises(Exception):
+        maabe.decrypt(gp, user_key(maabe, gp, sks, missing, keygen), ct, cheapest)
+
+
+def test_keys_of_another_user_do_not_decrypt(scheme):
+    group, maabe, gp, pks, sks = scheme
+    message = group.random(GT)
+    ct = maabe.encrypt(gp, pks, message, 'A@AUTH1 and B@AUTH2')
+    user_sk = user_key(maabe, gp, sks, ['A@AUTH1', 'B@AUTH2'], 'multiple_attributes')
+    user_sk['GID'] = '0xother'
+    assert maabe.decrypt(gp, user_sk, ct) != message
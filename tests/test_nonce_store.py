@@ -0,0 +1,118 @@
+import time
+import sqlite3
+from nonce_store import NonceStore
+
+SCHEMA = ("CREATE TABLE handshake_numbers (process_instance TEXT, reader_address TEXT, handshake_number TEXT, "
+          "primary key (process_instance, reader_address))")
+
+
+def test_consume_once():
+    store = NonceStore()
+    number = store.issue(1, '0xreader')
+    assert store.number(1, '0xreader') == number
+    assert store.consume(1, '0xreader', number)
+    assert not store.consume(1, '0xreader', number)
+    assert store.number(1, '0xreader') is None
+
+
+def test_wrong_number_does_not_consume():
+    store = NonceStore()
+    number = store.issue(1, '0xreader')
+    assert not store.consume(1, '0xreader', str(int(number) + 1))
+    assert store.number(1, '0xreader') == number
+
+
+def test_new_number_replaces_pending_one():
+    store = NonceStore()
+    first = store.issue(1, '0xreader')
+    second = store.issue(1, '0xreader')
+    assert not store.consume(1, '0xreader', first)
+    assert store.consume(1, '0xreader', second)
+
+
+def test_expiry():
+    store = NonceStore(ttl=0.05)
+    number = store.issue(1, '0xreader')
+    time.sleep(0.1)
+    assert store.number(1, '0xreader') is None
+    assert not store.consume(1, '0xreader', number)
+
+
+def test_size_bound():
+    store = NonceStore(size=2)
+    first = store.issue(1, 'a')
+    store.issue(1, 'b')
+    store.issue(1, 'c')
+    assert store.number(1, 'a') is None
+    assert not store.consume(1, 'a', first)
+
+
+def test_persisted_numbers(tmp_path):
+    database = str(tmp_path / 'authority.db')
+    connection = sqlite3.connect(database)
+    connection.execute(SCHEMA)
+    # A row written before the expiry was persisted, possibly used already
+    connection.execute("INSERT INTO handshake_numbers VALUES ('1', 'old', '42')")
+    connection.commit()
+    store = NonceStore(database=database, flush_interval=60)
+    assert store.number(1, 'old') is None
+    number = store.issue(1, '0xreader')
+    store.flush()
+    assert connection.execute("SELECT handshake_number FROM handshake_numbers").fetchall() == [(number,)]
+    # A restart keeps the pending number, with its expiry
+    restarted = NonceStore(database=database, flush_interval=60)
+    assert restarted.number(1, '0xreader') == number
+    assert restarted.consume(1, '0xreader', number)
+    restarted.flush()
+    assert connection.execute("SELECT * FROM handshake_numbers").fetchall() == []
+
+
+def test_expired_persisted_numbers_are_dropped(tmp_path):
+    database = str(tmp_path / 'authority.db')
+    connection = sqlite3.connect(database)
+    connection.execute(SCHEMA)
+    connection.execute("ALTER TABLE handshake_numbers ADD COLUMN expires REAL")
+    connection.execute("INSERT INTO handshake_numbers VALUES ('1', '0xreader', '42', ?)", (time.time() - 1,))
+    connection.commit()
+    store = NonceStore(database=database)
+    assert store.number(1, '0xreader') is None
+    assert connection.execute("SELECT * FROM handshake_numbers").fetchall() == []
+
+
+def test_failed_writes_are_retried(tmp_path):
+    database = str(tmp_path / 'authority.db')
+    connection = sqlite3.connect(database)
+    connection.execute(SCHEMA)
+    connection.commit()
+    store = NonceStore(database=database, flush_interval=60)
+    connection.execute("ALTER TABLE handshake_numbers RENAME TO moved")
+    connection.commit()
+    number = store.issue(1, '0xreader')
+    store.flush()
+    assert len(store.pending) == 1
+    connection.execute("ALTER TABLE moved RENAME TO handshake_numbers")
+    connection.commit()
+    store.flush()
+    assert connection.execute("SELECT handshake_number FROM handshake_numbers").fetchall() == [(number,)]
+
+
+def test_pending_changes_are_bounded(tmp_path):
+    database = str(tmp_path / 'authority.db')
+    connection = sqlite3.connect(database)
+    connection.execute(SCHEMA)
+    connection.commit()
+    store = NonceStore(database=database, flush_interval=60, max_pending=2)
+    store.issue(1, 'a')
+    store.issue(1, 'a')
+    store.issue(1, 'b')
+    assert len(store.pending) == 2
+    # Past the bound the caller writes the changes
+    number = store.issue(1, 'c')
+    assert not store.pending
+    assert connection.execute("SELECT handshake_number FROM handshake_numbers WHERE reader_address='c'").fetchall() == [(number,)]
+    # And drops them when the database keeps failing
+    connection.execute("DROP TABLE handshake_numbers")
+    connection.commit()
+    for reader in ['d', 'e', 'f']:
+        store.issue(1, reader)
+    assert not store.pending
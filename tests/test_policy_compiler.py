@@ -0,0 +1,31 @@
+import random
+import pytest
+
+pytest.importorskip('charm')
+from charm.toolbox.policytree import PolicyParser
+from policy_util import PolicyUtil
+from policy_compiler import PolicyCompiler
+from test_policy_util import attribute_sets, random_policy, satisfied
+
+
+def test_normalize_matches_charm():
+    util = PolicyUtil(None)
+    compiler = PolicyCompiler(util)
+    rng = random.Random(5)
+    for _ in range(200):
+        policy = random_policy(rng, 3)
+        normalized = compiler.normalize(policy)
+        charm_tree = PolicyParser().parse(policy)
+        # Without threshold gates the normalized policy is read by the charm parser too
+        normalized_tree = PolicyParser().parse(normalized)
+        for attributes in attribute_sets():
+            assert satisfied(util, normalized_tree, attributes) == satisfied(util, charm_tree, attributes), \
+                (policy, normalized, attributes)
+        assert compiler.normalize(normalized) == normalized
+
+
+def test_normalize_keeps_left_to_right_grouping():
+    compiler = PolicyCompiler(PolicyUtil(None))
+    assert compiler.normalize('A@X or B@X and C@X') == '((A@X or B@X) and C@X)'
+    assert compiler.normalize('A@X or (A@X and B@X)') == 'A@X'
+    assert compiler.normalize('B@X and A@X and (A@X or C@X)') == '(A@X and B@X)'
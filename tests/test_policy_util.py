@@ -0,0 +1,66 @@
+import random
+import itertools
+import pytest
+
+pytest.importorskip('charm')
+from charm.toolbox.policytree import PolicyParser
+from policy_util import PolicyUtil, ThresholdPolicyParser
+
+ATTRIBUTES = ['A@X', 'B@X', 'C@X', 'D@X', 'E@X']
+
+
+def satisfied(util, node, attributes):
+    gate = util.gate(node)
+    if gate is None:
+        return node.getAttribute() in attributes
+    threshold, children = gate
+    return sum(satisfied(util, child, attributes) for child in children) >= threshold
+
+
+def random_policy(rng, depth):
+    # AND/OR chains, mixed and not always parenthesized
+    if depth == 0 or rng.random() < 0.3:
+        return rng.choice(ATTRIBUTES)
+    chain = random_policy(rng, depth - 1)
+    for _ in range(rng.randint(1, 3)):
+        chain += rng.choice([' and ', ' or ']) + random_policy(rng, depth - 1)
+    return '(' + chain + ')' if rng.random() < 0.5 else chain
+
+
+def attribute_sets():
+    return [set(attributes) for k in range(len(ATTRIBUTES) + 1) for attributes in itertools.combinations(ATTRIBUTES, k)]
+
+
+def test_mixed_chain_is_grouped_left_to_right():
+    assert str(ThresholdPolicyParser().parse('A@X or B@X and C@X')) == '((A@X or B@X) and C@X)'
+    assert str(ThresholdPolicyParser().parse('A@X and B@X or C@X and D@X')) == '(((A@X and B@X) or C@X) and D@X)'
+
+
+def test_parser_matches_charm():
+    util = PolicyUtil(None)
+    rng = random.Random(4)
+    for _ in range(200):
+        policy = random_policy(rng, 3)
+        charm_tree = PolicyParser().parse(policy)
+        tree = ThresholdPolicyParser().parse(policy)
+        for attributes in attribute_sets():
+            assert satisfied(util, tree, attributes) == satisfied(util, charm_tree, attributes), (policy, attributes)
+
+
+def test_threshold_gate_does_not_change_grouping():
+    util = PolicyUtil(None)
+    with_gate = util.createPolicy('A@X or B@X and C@X and 1 of (D@X)')
+    without_gate = util.createPolicy('A@X or B@X and C@X and D@X')
+    for attributes in attribute_sets():
+        assert satisfied(util, with_gate, attributes) == satisfied(util, without_gate, attributes), attributes
+    assert not satisfied(util, with_gate, {'A@X', 'D@X'})
+
+
+def test_threshold_gate():
+    util = PolicyUtil(None)
+    tree = util.createPolicy('2 of (A@X, B@X and C@X, D@X)')
+    assert satisfied(util, tree, {'A@X', 'D@X'})
+    assert satisfied(util, tree, {'B@X', 'C@X', 'D@X'})
+    assert not satisfied(util, tree, {'A@X', 'B@X'})
+    with pytest.raises(Exception):
+        util.createPolicy('3 of (A@X, B@X)')
@@ -0,0 +1,68 @@
+import sqlite3
+import pytest
+
+pytest.importorskip('charm.core.engine.util')
+from reader_key_ring import ReaderKeyRing
+from conftest import SerializingGroup
+
+USER_SK = {'GID': '0xreader',
+           'keys': {'A@AUTH1': {'K': (1, b'\x02' * 65), 'KP': (1, b'\x03' * 65)},
+                    'B@AUTH2': {'K': (2, b'\x00'), 'KP': (1, b'')}}}
+
+
+@pytest.fixture
+def connection():
+    connection = sqlite3.connect(':memory:')
+    connection.execute("CREATE TABLE authorities_generated_decription_keys (process_instance TEXT, reader_address TEXT, "
+                       "authority_name TEXT, decription_key TEXT, primary key (process_instance, reader_address, authority_name))")
+    connection.execute("INSERT INTO authorities_generated_decription_keys VALUES ('1', '0xreader', 'Auth-1', 'key 1')")
+    connection.commit()
+    yield connection
+    connection.close()
+
+
+def key_ring(connection, assembled):
+    ring = ReaderKeyRing(SerializingGroup(), connection, ['AUTH1', 'AUTH2'])
+
+    def assemble(process_instance_id, reader_address):
+        assembled.append((str(process_instance_id), reader_address))
+        return USER_SK
+    ring.assemble = assemble
+    return ring
+
+
+def test_encode_decode(connection):
+    ring = ReaderKeyRing(SerializingGroup(), connection, [])
+    assert ring.decode(ring.encode(USER_SK)) == USER_SK
+
+
+def test_decode_rejects_other_data(connection):
+    ring = ReaderKeyRing(SerializingGroup(), connection, [])
+    with pytest.raises(Exception, match='Not a reader key ring'):
+        ring.decode(b'{"GID": "0xreader"}')
+
+
+def test_key_ring_is_assembled_once(connection):
+    assembled = []
+    assert key_ring(connection, assembled).user_secret_key(1, '0xreader') == USER_SK
+    assert key_ring(connection, assembled).user_secret_key(1, '0xreader') == USER_SK
+    assert assembled == [('1', '0xreader')]
+
+
+def test_new_generated_key_invalidates_key_ring(connection):
+    assembled = []
+    ring = key_ring(connection, assembled)
+    fingerprint = ring.fingerprint(1, '0xreader')
+    ring.user_secret_key(1, '0xreader')
+    connection.execute("INSERT INTO authorities_generated_decription_keys VALUES ('1', '0xreader', 'Auth-2', 'key 2')")
+    connection.commit()
+    assert ring.fingerprint(1, '0xreader') != fingerprint
+    ring.user_secret_key(1, '0xreader')
+    key_ring(connection, assembled).user_secret_key(1, '0xreader')
+    assert assembled == [('1', '0xreader'), ('1', '0xreader')]
+
+
+def test_fingerprint_depends_on_reader_and_instance(connection):
+    ring = ReaderKeyRing(SerializingGroup(), connection, [])
+    assert ring.fingerprint(1, '0xreader') != ring.fingerprint(1, '0xother')
+    assert ring.fingerprint(1, '0xreader') != ring.fingerprint(2, '0xreader')
@@ -0,0 +1,90 @@
+import pytest
+from concurrent.futures import Future
+
+for module in ('decouple', 'web3', 'ipfshttpclient', 'charm.toolbox.pairinggroup'):
+    pytest.importorskip(module)
+import server_authority
+import wire_protocol
+
+
+@pytest.fixture
+def server(monkeypatch):
+    # The globals set by the command line of the server
+    monkeypatch.setattr(server_authority, 'MAX_BATCH', 10, raising=False)
+    monkeypatch.setattr(server_authority, 'BATCH_CHUNK', 2, raising=False)
+    server = server_authority.AuthorityServer(1)
+    monkeypatch.setattr(server, 'check_handshake', lambda process_instance_id, reader_address, signature, number_to_sign=None: signature == 'valid')
+    monkeypatch.setattr(server.public_keys, 'warm', lambda reader_addresses: 0)
+    return server
+
+
+def frames(reply):
+    # The type and fields of the frames of a reply
+    decoded = []
+    for frame in ([reply] if isinstance(reply, bytes) else reply):
+        _, message_type, _ = wire_protocol.FRAME_HEADER.unpack_from(frame)
+        decoded.append((message_type, wire_protocol.unpack_fields(frame[wire_protocol.FRAME_HEADER.size:], decode=False)))
+    return decoded
+
+
+def signed_key_request(server, session, signature='valid'):
+    server.process_frame(wire_protocol.KEY_REQUEST, wire_protocol.pack_fields('1', '0xreader'), session)
+    return frames(server.process_frame(wire_protocol.SIGNED_KEY_REQUEST,
+                                       wire_protocol.pack_fields('0xreader', '1', '0xreader', signature), session))
+
+
+@pytest.mark.parametrize('error, message', [(KeyError('0xreader'), b'No attributes certified for the reader'),
+                                            (OSError('IPFS not available'), b'Key generation failed: IPFS not available')])
+def test_key_generation_error_is_replied(server, monkeypatch, error, message):
+    def generate_key_auth(*args, **kwargs):
+        raise error
+    monkeypatch.setattr(server, 'generate_key_auth', generate_key_auth)
+    assert signed_key_request(server, {}) == [(wire_protocol.ERROR, [message])]
+
+
+def test_invalid_signature(server):
+    assert signed_key_request(server, {}, 'forged') == [(wire_protocol.ERROR, [b'Invalid signature'])]
+
+
+def test_batch_key_generation_error_is_replied(server, monkeypatch):
+    def generate_user_keys(authority_number, process_instance_id, readers):
+        raise OSError('chain not available')
+    monkeypatch.setattr(server_authority.authority_key_generation, 'generate_user_keys', generate_user_keys, raising=False)
+    session = {}
+    server.process_frame(wire_protocol.BATCH_KEY_REQUEST, wire_protocol.pack_fields('1', 'a', 'b', 'c'), session)
+    reply = server.process_frame(wire_protocol.BATCH_SIGNED_KEY_REQUEST,
+                                 wire_protocol.pack_fields('1', 'a', 'valid', 'b', 'forged', 'c', 'valid'), session)
+    assert frames(reply) == [(wire_protocol.ERROR, [b'Invalid signature', b'b']),
+                             (wire_protocol.ERROR, [b'chain not available', b'a']),
+                             (wire_protocol.ERROR, [b'chain not available', b'c']),
+                             (wire_protocol.BATCH_END, [b'0'])]
+
+
+class BrokenPool:
+    # A pool whose worker died: the futures of its tasks fail with BrokenProcessPool
+    def submit(self, function, *args):
+        future = Future()
+        future.set_exception(server_authority.BrokenProcessPool('A worker died'))
+        return future
+
+    def shutdown(self, wait=True):
+        self.closed = True
+
+
+def test_broken_keygen_pool_is_replaced(server, monkeypatch):
+    def generate_user_keys(authority_number, process_instance_id, readers):
+        return [(reader_address, b'key of ' + reader_address.encode(), None) for reader_address in readers]
+    monkeypatch.setattr(server_authority.authority_key_generation, 'generate_user_keys', generate_user_keys, raising=False)
+    started = []
+    monkeypatch.setattr(server, 'keygen_pool', lambda start_method: started.append(start_method) or 'new pool')
+    broken = server.keygen_executor = BrokenPool()
+    session = {}
+    server.process_frame(wire_protocol.BATCH_KEY_REQUEST, wire_protocol.pack_fields('1', 'a', 'b', 'c'), session)
+    reply = server.process_frame(wire_protocol.BATCH_SIGNED_KEY_REQUEST,
+                                 wire_protocol.pack_fields('1', 'a', 'valid', 'b', 'valid', 'c', 'valid'), session)
+    replies = frames(reply)
+    # The chunks of the broken pool are generated by the request worker
+    assert sorted(replies[:-1]) == [(wire_protocol.BATCH_KEY, [reader_address, b'key of ' + reader_address])
+                                    for reader_address in [b'a', b'b', b'c']]
+    assert replies[-1] == (wire_protocol.BATCH_END, [b'3'])
+    assert broken.closed and started == ['forkserver'] and server.keygen_executor == 'new pool'
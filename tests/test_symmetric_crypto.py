@@ -0,0 +1,89 @@
+import io
+import os
+import pytest
+
+pytest.importorskip('Crypto')
+from symmetric_crypto import (CHUNK_SIZE, MAGIC, PREFIX_LENGTH, decrypt_stream, derive_key, encrypt_stream,
+                              read_slice_key, write_slice)
+
+KEY = b'serialized GT element'
+
+
+def encrypt(data, chunk_size=CHUNK_SIZE, key=KEY):
+    destination = io.BytesIO()
+    encrypt_stream(key, io.BytesIO(data), destination, chunk_size)
+    return destination.getvalue()
+
+
+def decrypt(data, key=KEY):
+    destination = io.BytesIO()
+    decrypt_stream(key, io.BytesIO(data), destination)
+    return destination.getvalue()
+
+
+@pytest.mark.parametrize('size', [0, 1, 999, 1000, 1001, 5000])
+def test_round_trip(size):
+    data = os.urandom(size)
+    assert decrypt(encrypt(data, chunk_size=1000)) == data
+
+
+def test_wrong_key():
+    with pytest.raises(ValueError):
+        decrypt(encrypt(b'data'), key=b'another key')
+
+
+def test_tampered_chunk():
+    encrypted = bytearray(encrypt(os.urandom(3000), chunk_size=1000))
+    encrypted[len(MAGIC) + PREFIX_LENGTH + 4 + 10] ^= 1
+    with pytest.raises(ValueError):
+        decrypt(bytes(encrypted))
+
+
+def test_truncated_file():
+    encrypted = encrypt(os.urandom(3000), chunk_size=1000)
+    with pytest.raises(Exception):
+        decrypt(encrypted[:-1])
+
+
+def test_dropped_last_chunk():
+    # Cutting at a chunk boundary leaves a file whose last chunk is not marked as last
+    encrypted = encrypt(os.urandom(3000), chunk_size=1000)
+    chunk = 4 + 1000 + 16
+    with pytest.raises(Exception):
+        decrypt(encrypted[:len(MAGIC) + PREFIX_LENGTH + 2 * chunk])
+
+
+def test_reordered_chunks():
+    encrypted = encrypt(os.urandom(3000), chunk_size=1000)
+    header, chunk = len(MAGIC) + PREFIX_LENGTH, 4 + 1000 + 16
+    first, second = encrypted[header:header + chunk], encrypted[header + chunk:header + 2 * chunk]
+    with pytest.raises(ValueError):
+        decrypt(encrypted[:header] + second + first + encrypted[header + 2 * chunk:])
+
+
+def test_trailing_data():
+    with pytest.raises(Exception):
+        decrypt(encrypt(b'data') + b'x')
+
+
+def test_not_an_encrypted_file():
+    with pytest.raises(Exception):
+        decrypt(b'plain text file content')
+
+
+def test_derive_key():
+    assert len(derive_key(KEY, 'slice-1')) == 32
+    assert derive_key(KEY, 'slice-1') == derive_key(KEY, 'slice-1')
+    assert derive_key(KEY, 'slice-1') != derive_key(KEY, 'slice-2')
+
+
+@pytest.mark.parametrize('ciphered_key', [b'', b'abe ciphertext'])
+def test_slice(ciphered_key):
+    data = os.urandom(2500)
+    destination = io.BytesIO()
+    write_slice(KEY, ciphered_key, io.BytesIO(data), destination, 1000)
+    source = io.BytesIO(destination.getvalue())
+    assert read_slice_key(source) == ciphered_key
+    output = io.BytesIO()
+    decrypt_stream(KEY, source, output)
+    assert output.getvalue() == data
@@ -0,0 +1,102 @@
+import socket
+import struct
+import pytest
+import wire_protocol
+from conftest import SerializingGroup
+from wire_protocol import FrameReader, MAGIC, FRAME_HEADER, MAX_FIELD, pack_fields, pack_frame, unpack_fields
+
+
+@pytest.fixture
+def sockets():
+    left, right = socket.socketpair()
+    yield left, right
+    left.close()
+    right.close()
+
+
+def test_fields_round_trip():
+    fields = ['', 'process instance', 'è§', 'x' * MAX_FIELD]
+    assert unpack_fields(pack_fields(*fields)) == fields
+    assert unpack_fields(pack_fields(b'\x00\xff', 'a'), decode=False) == [b'\x00\xff', b'a']
+
+
+def test_field_too_large():
+    with pytest.raises(Exception, match='too large'):
+        pack_fields('x' * (MAX_FIELD + 1))
+    with pytest.raises(Exception, match='too large'):
+        pack_fields(b'x' * 70000)
+
+
+@pytest.mark.parametrize('length', [1, 4, 6, 9])
+def test_truncated_fields(length):
+    # Cut in the length prefix or in the value of a field
+    with pytest.raises(ValueError, match='Truncated'):
+        unpack_fields(pack_fields('abc', 'def')[:length])
+
+
+def test_frames(sockets):
+    left, right = sockets
+    left.sendall(pack_frame(wire_protocol.KEY_REQUEST, pack_fields('1', '0xreader')) + pack_frame(wire_protocol.DISCONNECT))
+    reader = FrameReader(right, size=8)
+    message_type, payload = reader.read_frame()
+    assert message_type == wire_protocol.KEY_REQUEST
+    assert unpack_fields(payload) == ['1', '0xreader']
+    assert reader.read_frame() == (wire_protocol.DISCONNECT, memoryview(b''))
+
+
+def test_frame_with_detected_magic(sockets):
+    left, right = sockets
+    left.sendall(pack_frame(wire_protocol.PARTIAL_KEY, b'key'))
+    reader = FrameReader(right)
+    magic = bytes(reader.read_into(len(MAGIC)))
+    assert magic == MAGIC
+    message_type, payload = reader.read_frame(magic)
+    assert (message_type, bytes(payload)) == (wire_protocol.PARTIAL_KEY, b'key')
+
+
+@pytest.mark.parametrize('length', [3, FRAME_HEADER.size - 1, FRAME_HEADER.size + 2])
+def test_truncated_frame(sockets, length):
+    left, right = sockets
+    left.sendall(pack_frame(wire_protocol.PARTIAL_KEY, b'partial key')[:length])
+    left.shutdown(socket.SHUT_WR)
+    with pytest.raises(ConnectionError):
+        FrameReader(right).read_frame()
+
+
+def test_unsupported_version(sockets):
+    left, right = sockets
+    left.sendall(FRAME_HEADER.pack(b'CGW\x02', wire_protocol.KEY_REQUEST, 0))
+    with pytest.raises(Exception, match='Unsupported protocol version'):
+        FrameReader(right).read_frame()
+
+
+def test_frame_too_large(sockets):
+    left, right = sockets
+    left.sendall(FRAME_HEADER.pack(MAGIC, wire_protocol.KEY_REQUEST, wire_protocol.MAX_PAYLOAD + 1))
+    with pytest.raises(Exception, match='Frame too large'):
+        FrameReader(right).read_frame()
+
+
+def test_key_round_trip():
+    group = SerializingGroup()
+    user_key = {'A@AUTH1': {'K': (1, b'\x02' * 65), 'KP': (1, b'\x03' * 65)},
+                'B@AUTH1': {'K': (2, b'\x00'), 'KP': (1, b'')}}
+    assert wire_protocol.decode_key(group, wire_protocol.encode_key(group, user_key)) == user_key
+    assert wire_protocol.encode_key(group, {}) == struct.pack('>H', 0)
+
+
+@pytest.mark.parametrize('length', [0, 1, 3, 5, 20, -1])
+def test_truncated_key(length):
+    group = SerializingGroup()
+    payload = wire_protocol.encode_key(group, {'A@AUTH1': {'K': (1, b'\x02' * 65), 'KP': (1, b'\x03' * 65)}})
+    with pytest.raises(ValueError, match='Truncated'):
+        wire_protocol.decode_key(group, payload[:length])
+
+
+def test_key_with_trailing_data():
+    group = SerializingGroup()
+    payload = wire_protocol.encode_key(group, {'A@AUTH1': {'K': (1, b'\x02'), 'KP': (1, b'\x03')}})
+    with pytest.raises(ValueError, match='Trailing'):
+        wire_protocol.decode_key(group, payload + b'\x00')
+    with pytest.raises(ValueError, match='Empty'):
+        wire_protocol.decode_key(group, struct.pack('>H', 1) + pack_fields('A@AUTH1', b'', b'\x01'))